@@ -1,32 +1,658 @@
 #!/usr/bin/env python
-import boto3
-from botocore.exceptions import ClientError
-import yaml
-import pprint
 import json
 import argparse
+import base64
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import importlib
+import itertools
 import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from os.path import basename, splitext
+from typing import NamedTuple
 
-pp = pprint.PrettyPrinter(indent=4)
+
+class LazyModule:
+    """Stands in for a module that is only imported when one of its attributes is first used.
+
+    boto3 and botocore take hundreds of milliseconds to import, so they are only
+    loaded on code paths that talk to AWS and --help or offline actions stay fast.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr: str):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+boto3 = LazyModule('boto3')
+botocore_config = LazyModule('botocore.config')
+botocore_exceptions = LazyModule('botocore.exceptions')
+yaml = LazyModule('yaml')
 DEBUG = False
+DEFAULT_CONCURRENCY = 10
+
+# Exit codes, plan and update return EXIT_CHANGES when changes are left pending
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_CHANGES = 2
+
+# Kinds of changes yielded by iter_changes
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+SAME = 'same'
+
+# Seconds a cached live config stays valid
+DEFAULT_CACHE_TTL = 300
+# Seconds --wait and rolling updates wait for environments to be Ready
+DEFAULT_WAIT_TIMEOUT = 1800
+# Seconds watch takes to check every environment once
+DEFAULT_WATCH_INTERVAL = 300
+
+# Retries of throttled API calls, and of reads failing with transient errors
+DEFAULT_RETRIES = 5
+# Requests per second allowed to each region, shared by every thread
+RATE_LIMIT = 10
+THROTTLING_ERROR_CODES = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException'}
+
+# Top level keys of a config file, the first three are required once Extends are resolved
+REQUIRED_CONFIG_KEYS = ('Region', 'ApplicationName', 'EnvironmentID')
+CONFIG_KEYS = REQUIRED_CONFIG_KEYS + ('EnvironmentName', 'EnvConfig', 'Extends')
+# Beanstalk limits on environment properties, checked offline by validate
+MAX_OPTION_NAME_LENGTH = 128
+MAX_OPTION_VALUE_LENGTH = 256
+MAX_ENV_CONFIG_BYTES = 4096
+# Files left to check before validate spreads them over a process pool
+VALIDATE_POOL_THRESHOLD = 200
+# Format of the validate cache file, entries of other versions are ignored
+VALIDATE_CACHE_VERSION = 1
 
-#TODO: add support for encryption of sensitive values
-#TODO: add support for removing options
-#TODO: add verification action such as 'plan' or 'verify'
 #TODO: reorder yaml output so environment name and id are above EnvConfig
 
 class EnvironmentNotFound(Exception):
     pass
 
 
+class ConfigError(Exception):
+    pass
+
+
+class DuplicateEnvironment(ConfigError):
+    pass
+
+
+class SecretError(ConfigError):
+    pass
+
+
+class EnvironmentRef(NamedTuple):
+    """Identifies one Beanstalk environment."""
+    region: str
+    app_name: str
+    env_id: str
+    env_name: str = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'EnvironmentRef':
+        """Build a ref from a config file or get_config dict."""
+        return cls(config['Region'], config['ApplicationName'], config['EnvironmentID'], config.get('EnvironmentName'))
+
+
+class ConfigSnapshot(NamedTuple):
+    """The live EnvConfig of an environment, as fetched at fetched_at."""
+    ref: EnvironmentRef
+    env_config: dict
+    fetched_at: datetime
+
+
+class ChangeSet(NamedTuple):
+    """Changes that bring an environment's live EnvConfig to the desired one.
+
+    added maps new variables to their values, removed lists variables to delete
+    and modified maps changed variables to (new, old) value pairs. secrets names
+    variables whose values must not be shown, source is the config file the
+    desired EnvConfig came from and error is set when the change set couldn't
+    be computed.
+    """
+    ref: EnvironmentRef
+    added: dict
+    removed: list
+    modified: dict
+    secrets: frozenset = frozenset()
+    source: str = None
+    error: str = None
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.removed or self.modified)
+
+    def masked(self) -> 'ChangeSet':
+        """Return a copy fit for output, with values of secret variables masked."""
+        if not self.secrets:
+            return self
+        return self._replace(
+            added={key: SECRET_MASK if key in self.secrets else value for key, value in self.added.items()},
+            modified={key: (SECRET_MASK, SECRET_MASK) if key in self.secrets else values
+                      for key, values in self.modified.items()})
+
+    def to_dict(self) -> dict:
+        """The json form printed by plan, with secrets masked."""
+        masked = self.masked()
+        result = {
+            "ApplicationName": self.ref.app_name,
+            "Region": self.ref.region,
+            "EnvironmentID": self.ref.env_id,
+            "EnvironmentName": self.ref.env_name,
+            "Added": masked.added,
+            "Removed": list(masked.removed),
+            "Modified": {key: {"Old": old, "New": new} for key, (new, old) in masked.modified.items()},
+            "Secrets": sorted(self.secrets),
+            "File": self.source,
+        }
+        if self.error:
+            result["Error"] = self.error
+        return result
+
+
+SECRET_REFERENCE = re.compile(r'^\{\{resolve:([a-z-]+):(.+)\}\}$')
+SECRET_MASK = '******'
+
+
+class ConfigCache:
+    """On-disk cache of fetched EnvConfig, one json file per environment.
+
+    An entry is used while it is younger than `ttl` seconds and the environment's
+    DateUpdated (from describe_environments) still matches the one it was stored with,
+    so any update to the environment invalidates it. With `refresh` entries are never
+    read, only rewritten. Live configs hold resolved secrets, so directories are
+    created readable by the owner only and entries are written with mode 0600.
+    """
+
+    def __init__(self, directory: str, ttl: int = DEFAULT_CACHE_TTL, refresh: bool = False):
+        self.directory = directory
+        self.ttl = ttl
+        self.refresh = refresh
+
+    def _path(self, region: str, env_id: str) -> str:
+        return os.path.join(self.directory, region or 'default', env_id + '.json')
+
+    def get(self, region: str, env: dict):
+        if self.refresh or 'DateUpdated' not in env:
+            return None
+        try:
+            with open(self._path(region, env['EnvironmentId']), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['FetchedAt'] > self.ttl or entry['DateUpdated'] != str(env['DateUpdated']):
+            return None
+        debug("using cached config for {}".format(env['EnvironmentId']))
+        return entry['EnvConfig']
+
+    def put(self, region: str, env: dict, env_vars: dict) -> None:
+        if 'DateUpdated' not in env:
+            return
+        path = self._path(region, env['EnvironmentId'])
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        entry = {'DateUpdated': str(env['DateUpdated']), 'FetchedAt': time.time(), 'EnvConfig': env_vars}
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, region: str, env_id: str) -> None:
+        try:
+            os.remove(self._path(region, env_id))
+        except FileNotFoundError:
+            pass
+
+
+class ConfigResolver:
+    """Loads config files, resolving the base files they list under 'Extends'.
+
+    A file's resolved config is its bases merged in order, then the file itself on
+    top. EnvConfig is merged variable by variable and a variable set to null is
+    removed. Resolved files are memoized together with the mtimes of every file
+    they were built from, so across a run each shared base is parsed only once,
+    and a file is only parsed again after it or one of its bases changes.
+    """
+
+    def __init__(self):
+        self._resolved = {}
+
+    def resolve(self, filename: str) -> dict:
+        """Return a copy of the resolved config of filename, safe for the caller to modify."""
+        config = self._resolve(os.path.abspath(filename), ())[1]
+        return dict(config, EnvConfig=dict(config['EnvConfig']))
+
+    def _resolve(self, path: str, chain: tuple) -> tuple:
+        if path in chain:
+            raise ConfigError("circular Extends: {}".format(" -> ".join(chain + (path,))))
+        cached = self._resolved.get(path)
+        if cached and all(mtime_ns(dep) == mtime for dep, mtime in cached[0].items()):
+            return cached
+        deps = {path: mtime_ns(path)}
+        extended_by = " (extended by {})".format(chain[-1]) if chain else ""
+        try:
+            data = load_yaml(path) or {}
+        except OSError as e:
+            raise ConfigError("can't read {}{}: {}".format(path, extended_by, e.strerror))
+        except yaml.YAMLError as e:
+            raise ConfigError("invalid yaml in {}{}: {}".format(path, extended_by, e))
+        if not isinstance(data, dict):
+            raise ConfigError("{}{} must be a mapping at the top level".format(path, extended_by))
+        bases = data.pop('Extends', None) or []
+        bases = [bases] if isinstance(bases, str) else bases
+        if not isinstance(bases, list) or not all(isinstance(base, str) for base in bases):
+            raise ConfigError("Extends of {}{} must be a file name or a list of them".format(path, extended_by))
+        config = {}
+        env_config = {}
+        for base in bases:
+            base_deps, base_config = self._resolve(os.path.join(os.path.dirname(path), base), chain + (path,))
+            deps.update(base_deps)
+            config.update(base_config)
+            env_config.update(base_config['EnvConfig'])
+        own_env_config = data.pop('EnvConfig', None) or {}
+        if not isinstance(own_env_config, dict):
+            raise ConfigError("EnvConfig of {}{} must be a mapping of variable names to values".format(
+                path, extended_by))
+        env_config.update(own_env_config)
+        config.update(data)
+        config['EnvConfig'] = {key: value for key, value in env_config.items() if value is not None}
+        self._resolved[path] = (deps, config)
+        return self._resolved[path]
+
+
+def mtime_ns(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def is_template(config: dict) -> bool:
+    """Files without an EnvironmentID are only bases for other files to extend."""
+    return 'EnvironmentID' not in config
+
+
+def check_required_keys(filename: str, config: dict) -> None:
+    """Raise ConfigError when a resolved config that isn't a template lacks any of REQUIRED_CONFIG_KEYS."""
+    missing = [key for key in REQUIRED_CONFIG_KEYS if key not in config]
+    if missing:
+        raise ConfigError("{} is missing {}".format(filename, ", ".join(missing)))
+
+
+class ConfigFileStore:
+    """Config files parsed once and kept in memory, reparsed only when they or their bases change."""
+
+    def __init__(self, paths: list):
+        self.paths = paths
+        self.resolver = ConfigResolver()
+        self._files = {}
+
+    def refresh(self) -> list:
+        """Pick up new, changed and deleted files and return the current configs, leaving out templates."""
+        files = {}
+        for filename in expand_config_paths(self.paths):
+            if not os.path.exists(filename):
+                continue
+            try:
+                file_config = self.resolver.resolve(filename)
+                if not is_template(file_config):
+                    check_required_keys(filename, file_config)
+            except (yaml.YAMLError, ConfigError, OSError) as e:
+                print("Failed to load {}: {}".format(filename, e))
+                if filename in self._files:
+                    files[filename] = self._files[filename]
+                continue
+            if not is_template(file_config):
+                file_config['File'] = filename
+                files[filename] = file_config
+        self._files = files
+        return list(files.values())
+
+
+class SsmSecretProvider:
+    """Reads parameters from SSM Parameter Store, decrypting SecureStrings, 10 names per request."""
+
+    def __init__(self, region: str):
+        self.client = boto3.session.Session().client('ssm', region_name=region)
+
+    def resolve(self, references: list) -> dict:
+        values = {}
+        for start in range(0, len(references), 10):
+            response = self.client.get_parameters(Names=references[start:start + 10], WithDecryption=True)
+            if response['InvalidParameters']:
+                raise SecretError("SSM parameters not found: {}".format(", ".join(response['InvalidParameters'])))
+            values.update((parameter['Name'], parameter['Value']) for parameter in response['Parameters'])
+        return values
+
+
+class KmsSecretProvider:
+    """Decrypts base64 encoded KMS ciphertexts. KMS has no batch decrypt, so one request per ciphertext."""
+
+    def __init__(self, region: str):
+        self.client = boto3.session.Session().client('kms', region_name=region)
+
+    def resolve(self, references: list) -> dict:
+        return {reference: self.client.decrypt(CiphertextBlob=base64.b64decode(reference))['Plaintext'].decode('utf-8')
+                for reference in references}
+
+
+# Provider factories by the scheme used in '{{resolve:<scheme>:<reference>}}' values
+SECRET_PROVIDERS = {
+    'ssm': SsmSecretProvider,
+    'ssm-secure': SsmSecretProvider,
+    'kms': KmsSecretProvider,
+}
+
+
+class SecretResolver:
+    """Replaces '{{resolve:<scheme>:<reference>}}' EnvConfig values with the secrets they point to.
+
+    References of all configs are collected first, deduplicated and handed to
+    their provider in one batch per scheme and region. Resolved values are
+    cached for the life of the resolver, so a reference shared by many
+    environments is only ever resolved once.
+    """
+
+    def __init__(self, providers: dict = None):
+        self.providers = dict(SECRET_PROVIDERS, **(providers or {}))
+        self._provider_instances = {}
+        self._values = {}
+
+    def resolve_configs(self, file_configs: list) -> None:
+        """Resolve references in place, listing the affected variables under 'SecretKeys'."""
+        wanted = {}
+        for file_config in file_configs:
+            for value in file_config['EnvConfig'].values():
+                reference = parse_secret_reference(value)
+                if reference and (file_config['Region'],) + reference not in self._values:
+                    wanted.setdefault((reference[0], file_config['Region']), set()).add(reference[1])
+        for (scheme, region), references in wanted.items():
+            if scheme not in self.providers:
+                raise SecretError("unknown secret scheme '{}'".format(scheme))
+            key = (scheme, region)
+            try:
+                if key not in self._provider_instances:
+                    self._provider_instances[key] = self.providers[scheme](region)
+                values = self._provider_instances[key].resolve(sorted(references))
+            # ValueError covers kms references that aren't valid base64 or don't decrypt to text
+            except (botocore_exceptions.ClientError, botocore_exceptions.BotoCoreError, ValueError) as e:
+                raise SecretError("{} secret {} could not be resolved: {}".format(
+                    scheme, ", ".join(sorted(references)), e))
+            for reference in references:
+                if reference not in values:
+                    raise SecretError("{} secret {} could not be resolved".format(scheme, reference))
+                self._values[(region, scheme, reference)] = values[reference]
+        for file_config in file_configs:
+            # A config can come back already resolved (ConfigFileStore keeps the last good one of a
+            # file that fails to parse), its values are still secret
+            secret_keys = list(file_config.get('SecretKeys', ()))
+            for name, value in file_config['EnvConfig'].items():
+                reference = parse_secret_reference(value)
+                if reference:
+                    file_config['EnvConfig'][name] = self._values[(file_config['Region'],) + reference]
+                    if name not in secret_keys:
+                        secret_keys.append(name)
+            file_config['SecretKeys'] = secret_keys
+
+
+def parse_secret_reference(value):
+    """Return (scheme, reference) if value is a '{{resolve:<scheme>:<reference>}}' marker, else None."""
+    match = SECRET_REFERENCE.match(value) if isinstance(value, str) else None
+    return match.groups() if match else None
+
+
 def debug(msg):
     if DEBUG:
         print(msg)
 
 
+_session = None
+_clients = {}
+_buckets = {}
+_clients_lock = threading.Lock()
+
+
+class Profiler:
+    """Timing spans of API calls and pipeline stages, off unless enabled.
+
+    Each finished span is written as a json line to `stream` when one is set, and
+    summary() renders count, total, p50 / p95 latency and bytes per span name.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stream = None
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def enable(self, stream=None) -> None:
+        self.enabled = True
+        self.stream = stream
+
+    def reset(self) -> None:
+        with self._lock:
+            self.enabled = False
+            self.stream = None
+            self.spans = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        """Time the block as span name. The block may add attributes, like 'bytes', to the yielded dict."""
+        if not self.enabled:
+            yield attrs
+            return
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            self.record(name, time.perf_counter() - start, started, attrs)
+
+    def profiled(self, name: str):
+        """Decorator timing every call of the function as span name."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name: str, duration: float, started: float, attrs: dict) -> None:
+        with self._lock:
+            durations, total_bytes = self.spans.get(name, ([], 0))
+            durations.append(duration)
+            self.spans[name] = (durations, total_bytes + attrs.get('bytes', 0))
+            if self.stream:
+                line = dict(attrs, span=name, start=started, duration_ms=round(duration * 1000, 3))
+                self.stream.write(json.dumps(line, default=str) + '\n')
+
+    def summary(self) -> str:
+        lines = ["{:<40} {:>7} {:>10} {:>10} {:>10} {:>12}".format(
+            "span", "count", "total (s)", "p50 (ms)", "p95 (ms)", "bytes")]
+        with self._lock:
+            for name, (durations, total_bytes) in sorted(self.spans.items()):
+                ordered = sorted(durations)
+                p50 = ordered[int(0.50 * (len(ordered) - 1))]
+                p95 = ordered[int(0.95 * (len(ordered) - 1))]
+                lines.append("{:<40} {:>7} {:>10.3f} {:>10.1f} {:>10.1f} {:>12}".format(
+                    name, len(ordered), sum(ordered), p50 * 1000, p95 * 1000, total_bytes))
+        return "\n".join(lines)
+
+
+PROFILER = Profiler()
+
+
+class RequestMetrics:
+    """Counters of API requests made through get_client clients, keyed by operation name."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.retries = Counter()
+        self.throttles = Counter()
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def count(self, counter: Counter, operation: str) -> None:
+        with self._lock:
+            counter[operation] += 1
+
+    def waited(self, seconds: float) -> None:
+        with self._lock:
+            self.wait_time += seconds
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.retries.clear()
+            self.throttles.clear()
+            self.wait_time = 0.0
+
+    def summary(self) -> str:
+        return "API calls: {}, retries: {}, throttled: {}, rate limit waits: {:.2f}s".format(
+            sum(self.calls.values()), sum(self.retries.values()), sum(self.throttles.values()), self.wait_time)
+
+
+METRICS = RequestMetrics()
+API_CALLS = METRICS.calls
+
+
+def count_api_call(model, **kwargs):
+    METRICS.count(METRICS.calls, model.name)
+
+
+class TokenBucket:
+    """Adaptive token bucket pacing the requests made to one region.
+
+    The rate is halved whenever a request is throttled. While requests succeed it
+    climbs back towards the configured maximum by about one request per second
+    every second.
+    """
+
+    def __init__(self, rate: float, min_rate: float = 0.5):
+        self.max_rate = self.rate = rate
+        self.min_rate = min_rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token, sleeping until one is available. Returns the seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1 / max(self.rate, 1))
+
+
+class RequestLayer:
+    """Wraps an elasticbeanstalk client so every API call is rate limited and retried.
+
+    Throttled calls are retried with exponential backoff and full jitter. Transient
+    errors (5xx, connection problems) are only retried for reads, which are safe
+    to repeat; everything else is raised straight away. Any other attribute is
+    passed through to the wrapped client, so Stubber and client.meta still work.
+    """
+
+    def __init__(self, client, bucket: TokenBucket, retries: int = DEFAULT_RETRIES, base_delay: float = 0.5,
+                 max_delay: float = 20):
+        self._client = client
+        self._bucket = bucket
+        self._retries = retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        operation = self._client.meta.method_to_api_mapping.get(name)
+        if operation is None:
+            return attr
+        idempotent = name.startswith(('describe_', 'list_', 'check_', 'validate_'))
+        return functools.partial(self._call, attr, operation, idempotent)
+
+    def _call(self, method, operation: str, idempotent: bool, **kwargs):
+        for attempt in range(self._retries + 1):
+            METRICS.waited(self._bucket.acquire())
+            try:
+                with PROFILER.span('api.' + operation, region=self._client.meta.region_name) as span:
+                    result = method(**kwargs)
+                    headers = result.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+                    span['bytes'] = int(headers.get('content-length', 0))
+            except botocore_exceptions.ClientError as e:
+                throttled = e.response['Error']['Code'] in THROTTLING_ERROR_CODES
+                transient = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+                if throttled:
+                    METRICS.count(METRICS.throttles, operation)
+                    self._bucket.throttled()
+                if attempt == self._retries or not (throttled or (idempotent and transient)):
+                    raise
+            except (botocore_exceptions.EndpointConnectionError, botocore_exceptions.ConnectionClosedError,
+                    botocore_exceptions.ReadTimeoutError):
+                if attempt == self._retries or not idempotent:
+                    raise
+            else:
+                self._bucket.succeeded()
+                return result
+            METRICS.count(METRICS.retries, operation)
+            delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+            debug("{} failed, retrying in {:.2f}s".format(operation, delay))
+            time.sleep(delay)
+
+
 def get_client(region="us-east-1"):
-    return boto3.client('elasticbeanstalk', region_name=region)
+    """Return the process-wide elasticbeanstalk client for the region, creating it on first use.
+
+    Clients are wrapped in a RequestLayer sharing one TokenBucket per region.
+    botocore's own retries are turned off so calls aren't retried twice.
+    """
+    global _session
+    with _clients_lock:
+        client = _clients.get(region)
+        if client is None:
+            if _session is None:
+                _session = boto3.session.Session()
+            with PROFILER.span('client', region=region):
+                config = botocore_config.Config(retries={'total_max_attempts': 1, 'mode': 'standard'})
+                raw_client = _session.client('elasticbeanstalk', region_name=region, config=config)
+            raw_client.meta.events.register('before-parameter-build.elastic-beanstalk', count_api_call)
+            bucket = _buckets.setdefault(region, TokenBucket(RATE_LIMIT))
+            client = _clients[region] = RequestLayer(raw_client, bucket)
+        return client
+
+
+def reset_clients():
+    global _session
+    with _clients_lock:
+        _session = None
+        _clients.clear()
+        _buckets.clear()
 
 
 def create_env_option(name: str, value: str) -> dict:
@@ -37,31 +663,114 @@ def create_env_option(name: str, value: str) -> dict:
     }
 
 
+def create_env_option_removal(name: str) -> dict:
+    return {
+        'Namespace': 'aws:elasticbeanstalk:application:environment',
+        'OptionName': name,
+    }
+
+
+def dedup_options_to_remove(options_to_update, options_to_remove) -> list:
+    """Drop removals that would clash with options being set, compared without surrounding whitespace.
+
+    CloudFormation allows variable names with whitespace at the start / end, but
+    everywhere else Beanstalk trims them. Removing ' NAME' would then remove the
+    'NAME' being set in the same update.
+    """
+    names = {name.strip() for name in options_to_update}
+    deduped = []
+    for name in sorted(options_to_remove):
+        if name.strip() not in names:
+            names.add(name.strip())
+            deduped.append(name)
+    return deduped
+
+
+def iter_changes(d1: dict, d2: dict, include_same: bool = False, ordered: bool = False):
+    """Lazily yield (change, key, d1 value, d2 value) for keys that differ between d1 and d2.
+
+    change is one of ADDED (only in d1), REMOVED (only in d2), MODIFIED or, with
+    include_same, SAME. Values missing from a side are None. With ordered changes
+    come sorted by key, otherwise in dict order, d1's keys first.
+    """
+    keys = sorted(d1.keys() | d2.keys()) if ordered else itertools.chain(d1, (k for k in d2 if k not in d1))
+    for key in keys:
+        if key not in d2:
+            yield ADDED, key, d1[key], None
+        elif key not in d1:
+            yield REMOVED, key, None, d2[key]
+        elif d1[key] != d2[key]:
+            yield MODIFIED, key, d1[key], d2[key]
+        elif include_same:
+            yield SAME, key, d1[key], d2[key]
+
+
 def dict_compare(d1: dict, d2: dict):
-    d1_keys = set(d1.keys())
-    d2_keys = set(d2.keys())
-    intersect_keys = d1_keys.intersection(d2_keys)
-    added = d1_keys - d2_keys
-    removed = d2_keys - d1_keys
-    modified = {o: (d1[o], d2[o]) for o in intersect_keys if d1[o] != d2[o]}
-    same = set(o for o in intersect_keys if d1[o] == d2[o])
+    added, removed, modified, same = set(), set(), {}, set()
+    for change, key, new, old in iter_changes(d1, d2, include_same=True):
+        if change == ADDED:
+            added.add(key)
+        elif change == REMOVED:
+            removed.add(key)
+        elif change == MODIFIED:
+            modified[key] = (new, old)
+        else:
+            same.add(key)
     return added, removed, modified, same
 
 
+def digest_config(env_config: dict) -> dict:
+    """Replace every value with a short digest, so snapshots can be kept and compared cheaply."""
+    return {key: hashlib.blake2b(str(value).encode('utf-8'), digest_size=16).digest()
+            for key, value in env_config.items()}
+
+
+def diff_snapshots(old: dict, new: dict):
+    """Yield (env_id, changes) for environments whose digested configs differ between two snapshots.
+
+    Snapshots map environment IDs to digest_config results. Environments that
+    only appear in one snapshot are compared against an empty config.
+    """
+    for env_id in sorted(old.keys() | new.keys()):
+        new_digests, old_digests = new.get(env_id, {}), old.get(env_id, {})
+        if new_digests != old_digests:
+            yield env_id, list(iter_changes(new_digests, old_digests, ordered=True))
+
+
 def to_file(filename: str, content: str):
-    with open(filename, 'w') as f:
+    with PROFILER.span('write') as span, open(filename, 'w') as f:
         f.write(content)
+        span['bytes'] = f.tell()
+
+
+@functools.lru_cache(maxsize=None)
+def yaml_backend() -> tuple:
+    """Return the (Loader, Dumper) pair to use, the LibYAML based ones when PyYAML was built with it."""
+    try:
+        return yaml.CSafeLoader, yaml.CSafeDumper
+    except AttributeError:  # PyYAML built without LibYAML
+        return yaml.SafeLoader, yaml.SafeDumper
+
+
+def dump_yaml(data: dict) -> str:
+    with PROFILER.span('dump') as span:
+        content = yaml.dump(data, Dumper=yaml_backend()[1], default_flow_style=False)
+        span['bytes'] = len(content)  # non-ascii characters are escaped, so this is the size in bytes
+    return content
 
 
 def save_yaml(filename: str, data: dict) -> None:
-    with open(filename, 'w') as f:
-        yaml.dump(data, f, default_flow_style=False)
+    """Dump data straight into filename, timed as one write span."""
+    with PROFILER.span('write') as span, open(filename, 'w') as f:
+        yaml.dump(data, f, Dumper=yaml_backend()[1], default_flow_style=False)
+        span['bytes'] = f.tell()
 
 
 def load_yaml(filename: str):
-    with open(filename, 'r') as stream:
+    with PROFILER.span('load') as span, open(filename, 'r') as stream:
+        span['bytes'] = os.fstat(stream.fileno()).st_size
         # try:
-        return yaml.load(stream)
+        return yaml.load(stream, Loader=yaml_backend()[0])
         # except yaml.YAMLError as exc:
         #     print(exc)
 
@@ -82,83 +791,218 @@ def get_environment_variables(client, env: dict) -> dict:
             env_vars[option['OptionName']] = option['Value']
     return env_vars
 
-def get_applications(client) -> dict:
-    apps = client.describe_applications()
+def paginate(operation, result_key: str, **params):
+    """Yield the result_key items of every page of a describe_* call as each page arrives.
+
+    NextToken is followed by hand rather than through a botocore paginator so that
+    every page request goes through the client's RequestLayer and is retried on its own.
+    """
+    while True:
+        response = operation(**params)
+        yield from response[result_key]
+        if not response.get('NextToken'):
+            return
+        params['NextToken'] = response['NextToken']
+
 
-    app_names = [ app['ApplicationName'] for app in apps['Applications']]
-    return app_names
+def get_applications(client):
+    # describe_applications isn't paginated, all applications come in one response
+    for app in client.describe_applications()['Applications']:
+        yield app['ApplicationName']
 
-def get_environments(client, app_name) -> list:
-    envs = client.describe_environments(ApplicationName=app_name)
-    return envs['Environments']
-     
-    
 
+def get_environments(client, app_name: str = None):
+    """Yield live environments of the application, or of every application when app_name is None.
 
+    Recently deleted and terminating environments are left out, their settings
+    can't be fetched any more.
+    """
+    params = {'ApplicationName': app_name} if app_name else {}
+    envs = paginate(client.describe_environments, 'Environments', IncludeDeleted=False, **params)
+    return (env for env in envs if env.get('Status') not in ('Terminating', 'Terminated'))
 
 
 def describe_environment(client, app_name: str, env_id: str) -> dict:
-    response = client.describe_environments(
-        ApplicationName=app_name,
-        EnvironmentIds=[env_id]
-    )
+    params = {'EnvironmentIds': [env_id]}
+    if app_name:
+        params['ApplicationName'] = app_name
+    response = client.describe_environments(**params)
     if len(response['Environments']) != 1:
         raise EnvironmentNotFound()
     return response['Environments'][0]
 
 
-def get_config(client, region, app_name, env_id) -> dict:
-    get_applications(client)
-    env = describe_environment(client, app_name, env_id)
-    debug("getting config for app {}, env {} ({})".format(app_name, env['EnvironmentName'], env_id))
-    env_vars = get_environment_variables(client, env)
-    config = {
-        "ApplicationName": app_name,
+def describe_environments_by_id(client, env_ids: list) -> dict:
+    """Describe many environments, possibly of different applications, in one request (per page)."""
+    envs = paginate(client.describe_environments, 'Environments', EnvironmentIds=list(env_ids))
+    return {env['EnvironmentId']: env for env in envs}
+
+
+def build_config(region: str, env: dict, env_vars: dict) -> dict:
+    return {
+        "ApplicationName": env['ApplicationName'],
         "Region": region,
-        "EnvironmentID": env_id,
+        "EnvironmentID": env['EnvironmentId'],
         "EnvironmentName": env['EnvironmentName'],
         "EnvConfig": env_vars
     }
-    return config
-    # print(yaml.dump(config, default_flow_style=False))
 
 
-def action_get(region: str, app_name: str, env_id: str, out_file: str):
+@PROFILER.profiled('fetch')
+def fetch_config(client, region: str, env: dict, cache: ConfigCache = None) -> dict:
+    """Build the config of a described environment, reusing its cached EnvConfig while valid."""
+    env_vars = cache.get(region, env) if cache else None
+    if env_vars is None:
+        env_vars = get_environment_variables(client, env)
+        if cache:
+            cache.put(region, env, env_vars)
+    return build_config(region, env, env_vars)
+
+
+def get_config(client, region, app_name, env_id, cache: ConfigCache = None) -> dict:
+    env = describe_environment(client, app_name, env_id)
+    debug("getting config for app {}, env {} ({})".format(app_name, env['EnvironmentName'], env_id))
+    return fetch_config(client, region, env, cache)
+
+
+def get_configs(client, region: str, env_ids: list, concurrency: int = DEFAULT_CONCURRENCY,
+                cache: ConfigCache = None, errors: dict = None) -> dict:
+    """Fetch configs of many environments in the region, keyed by environment ID.
+
+    All environments are looked up with a single describe_environments request.
+    IDs that don't match an environment are left out of the result. With an errors
+    dict, a ClientError fetching one environment's config is stored there under
+    its ID instead of failing the whole batch.
+    """
+    envs = describe_environments_by_id(client, env_ids)
+
+    def fetch(env):
+        try:
+            return fetch_config(client, region, env, cache)
+        except botocore_exceptions.ClientError as e:
+            if errors is None:
+                raise
+            errors[env['EnvironmentId']] = e
+            return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        configs = executor.map(fetch, envs.values())
+        return {env_id: config for env_id, config in zip(envs, configs) if config is not None}
+
+
+def iter_all_configs(client, region: str, concurrency: int = DEFAULT_CONCURRENCY, cache: ConfigCache = None):
+    """Yield configs of every environment in the region as soon as they are fetched.
+
+    Environments are listed page by page across all applications and each one is
+    handed to a pool of at most `concurrency` threads as it arrives; boto3 clients
+    are safe to share between threads. At most 2 * concurrency fetches are queued
+    at once, so memory stays flat however many environments there are.
+    Yields (env, config or None, fetched_at or None, error or None) tuples in
+    listing order, fetched_at being when that environment's config was fetched.
+    """
+    def fetch(env):
+        try:
+            config = fetch_config(client, region, env, cache)
+        except botocore_exceptions.ClientError as e:
+            return env, None, None, e
+        return env, config, datetime.now(timezone.utc), None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for env in get_environments(client):
+            pending.append(executor.submit(fetch, env))
+            while pending and (pending[0].done() or len(pending) >= 2 * concurrency):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_all_configs(client, region: str, concurrency: int = DEFAULT_CONCURRENCY, cache: ConfigCache = None) -> list:
+    """Fetch configs of every environment in the region, see iter_all_configs."""
+    return list(iter_all_configs(client, region, concurrency, cache))
+
+
+def get_all_region_configs(regions: list, concurrency: int = DEFAULT_CONCURRENCY, cache: ConfigCache = None) -> dict:
+    """Run get_all_configs for every region at once, returning results keyed by region."""
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        results = executor.map(lambda region: get_all_configs(get_client(region), region, concurrency, cache), regions)
+        return dict(zip(regions, results))
+
+
+def action_get_all(regions: list, out_dir: str, concurrency: int, cache: ConfigCache = None) -> int:
+    """Save configs of all environments in the regions, one region subdirectory each when several are given.
+
+    Regions are scanned at the same time and files are written as configs arrive.
+    Exits with EXIT_ERROR when the config of any environment couldn't be fetched.
+    """
+    def save_region(region):
+        region_dir = os.path.join(out_dir, region) if len(regions) > 1 else out_dir
+        os.makedirs(region_dir, exist_ok=True)
+        saved = failed = 0
+        for env, config, fetched_at, error in iter_all_configs(get_client(region), region, concurrency, cache):
+            if error:
+                failed += 1
+                print("Failed to get config for {} ({}): {}".format(env['EnvironmentName'], env['EnvironmentId'], error))
+                continue
+            out_file = os.path.join(region_dir, "{}-{}.yml".format(env['ApplicationName'], env['EnvironmentName']))
+            to_file(out_file, dump_yaml(config))
+            saved += 1
+            print("Saved config to {}".format(out_file))
+        if saved + failed == 0:
+            print("{} region doesn't have any beanstalk environments".format(region))
+        else:
+            print("Saved {} of {} environments in {}".format(saved, saved + failed, region))
+        return failed
+
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        failed = sum(executor.map(save_region, regions))
+    return EXIT_ERROR if failed else EXIT_OK
+
+
+def action_get(region: str, app_name: str, env_id: str, out_file: str, interactive: bool = True) -> int:
+    if not interactive and not (env_id and out_file):
+        print("--env-id and --out-file are required when not prompting")
+        return EXIT_ERROR
     client = get_client(region)
-    if not app_name:
-        availiable_apps = get_applications(client)
+    if not app_name and not env_id:
+        availiable_apps = []
+        for name in get_applications(client):
+            if not availiable_apps:
+                print("Availiable apps in {} region:".format(region))
+            print("{}: {}".format(len(availiable_apps), name))
+            availiable_apps.append(name)
         if len(availiable_apps) == 0:
             print("{} region doesn't have any beanstalk applications".format(region))
-            return
-        print("Availiable apps in {} region:".format(region))
-        for idx, name in enumerate(availiable_apps):
-            print("{}: {}".format(idx, name))
+            return EXIT_ERROR
         item = input("Select application [0-{}] ".format(len(availiable_apps)-1))
         try:
             app_name = availiable_apps[int(item)]
         except (IndexError, ValueError):
-            print("{} is invalid option. Quitting")
-            return
+            print("{} is invalid option. Quitting".format(item))
+            return EXIT_ERROR
         print("Selected {}".format(availiable_apps[int(item)]))
     if not env_id:
         print("env id not selected")
-        availiable_envs = get_environments(client, app_name)
+        availiable_envs = []
+        for env in get_environments(client, app_name):
+            if not availiable_envs:
+                print("Availiable environments for {}:".format(app_name))
+            print("{}: {} ({})".format(len(availiable_envs), env['EnvironmentName'], env['EnvironmentId']))
+            availiable_envs.append(env)
         if len(availiable_envs) == 0:
             print("{} doesn't have any environments".format(app_name))
-            return
-        print("Availiable environments for {}:".format(app_name))
-        for idx, env in enumerate(availiable_envs):
-            print("{}: {} ({})".format(idx, env['EnvironmentName'], env['EnvironmentId']))
+            return EXIT_ERROR
         item = input("Select environment to pull config for [0-{}] ".format(len(availiable_envs)-1))
         try:
             env = availiable_envs[int(item)]
         except (IndexError, ValueError):
-            print("{} is invalid option. Quitting")
-            return
+            print("{} is invalid option. Quitting".format(item))
+            return EXIT_ERROR
         print("Selected {}".format(env['EnvironmentName']))
-        env_id = env['EnvironmentId']
-    config = get_config(client, region, app_name, env_id)
-    raw_yaml = yaml.dump(config, default_flow_style=False)
+    else:
+        env = describe_environment(client, app_name, env_id)
+    config = build_config(region, env, get_environment_variables(client, env))
+    raw_yaml = dump_yaml(config)
     print(raw_yaml)
     if not out_file:
         out_file = input("Enter output filename to save config to: ")
@@ -168,97 +1012,992 @@ def action_get(region: str, app_name: str, env_id: str, out_file: str):
         out_file = out_file + ".yml"
     to_file(out_file, raw_yaml)
     print("Saved config to {}".format(out_file))
-        
+    return EXIT_OK
+
 
+def update_env(client, app_name: str, env_id:str , options_to_update: dict, options_to_remove) -> dict:
+    """Set options_to_update and remove options_to_remove with a single update, so one restart.
 
-def update_env(client, app_name: str, env_id:str , options_to_update: dict, options_to_remove):
+    Returns the update_environment response, errors are raised.
+    """
     option_settings = [create_env_option(k, v) for k, v in options_to_update.items()]
-    # TODO: do the OptionsToRemove bit
-    # remove_settings = [create_env_option(k, v) for k, v in options_to_remove.items()]
-    # Handle whitespaces in names. cloudformation allows creation of variable names
-    #with whitespaces at start / end, but everywhere else trims them.
-    # possibly trim whitespaces from variable names and 'deduplicate' these from ToRemove set
-    try:
-        response = client.update_environment(
-            ApplicationName=app_name,
-            EnvironmentId=env_id,
-            OptionSettings=option_settings,
-            # OptionsToRemove=[
-            #     {
-            #         'ResourceName': 'string',
-            #         'Namespace': 'string',
-            #         'OptionName': 'string'
-            #     },
-            # ]
-        )
-    except ClientError as e:
-        print("Client Error: {}".format(str(e)))
-        print()
-        print("NO CHANGES MADE. Please run the script again when environment state changes")
-        return
-    if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-        print("Update SUCCESSFUL. Application '{}' environment '{}' is restarting".format(app_name,
-                                                                                          response['EnvironmentName']))
+    remove_settings = [create_env_option_removal(k) for k in dedup_options_to_remove(options_to_update,
+                                                                                      options_to_remove)]
+    params = {}
+    if remove_settings:
+        params['OptionsToRemove'] = remove_settings
+    return client.update_environment(
+        ApplicationName=app_name,
+        EnvironmentId=env_id,
+        OptionSettings=option_settings,
+        **params
+    )
+
+
+@PROFILER.profiled('diff')
+def diff_config(ref: EnvironmentRef, desired: dict, live: dict, secrets=(), source: str = None) -> ChangeSet:
+    """Return the changes that bring an environment's live EnvConfig to the desired one."""
+    added, removed, modified = {}, [], {}
+    for change, key, new, old in iter_changes(desired, live, ordered=True):
+        if change == ADDED:
+            added[key] = new
+        elif change == REMOVED:
+            removed.append(key)
+        else:
+            modified[key] = (new, old)
+    return ChangeSet(ref, added, removed, modified, frozenset(secrets), source)
 
 
-def action_update(args: dict):
-    file_config = load_yaml(args.file)
-    # print(file_config.keys())
-    proposed_config = file_config['EnvConfig']
-    existing_config = get_config(file_config['Region'], file_config['ApplicationName'], file_config['EnvironmentID'])['EnvConfig']
+def plan_update(file_config: dict, existing_config: dict) -> ChangeSet:
+    """Describe the changes needed to bring an environment's live EnvConfig to the one in file_config."""
+    return diff_config(EnvironmentRef.from_config(file_config), file_config['EnvConfig'], existing_config,
+                       file_config.get('SecretKeys', ()), file_config.get('File'))
 
-    added, removed, modified, same = dict_compare(proposed_config, existing_config)
 
-    update_required = False
-    options_to_update = {}
-    options_to_remove = {}
-    if added:
-        update_required = True
+def print_plan(change_set: ChangeSet) -> None:
+    change_set = change_set.masked()
+    if change_set.added:
         print("Following variables will be ADDED:")
-        for key in added:
-            print("\t{}: {}".format(key, proposed_config[key]))
-            options_to_update[key] = proposed_config[key]
-    if removed:
-        update_required = True
-        print("Removed:")
-        pp.pprint(removed)
-    if modified:
-        update_required = True
+        for key, value in change_set.added.items():
+            print("\t{}: {}".format(key, value))
+    if change_set.removed:
+        print("Following variables will be REMOVED:")
+        for key in change_set.removed:
+            print("\t{}".format(key))
+    if change_set.modified:
         print("Following variables will be UPDATED:")
-        for key, (new, old) in modified.items():
-            options_to_update[key] = new
+        for key, (new, old) in change_set.modified.items():
             print("\t{}: {} -> {}".format(key, old, new))
 
-    if update_required:
-        if input("Update environment? [yes/no]: ") == 'yes':
-            update_env(get_client(file_config['Region']), file_config['ApplicationName'], file_config['EnvironmentID'], options_to_update,
-                       options_to_remove)
+
+@PROFILER.profiled('apply')
+def apply_plan(client, change_set: ChangeSet) -> ChangeSet:
+    """Apply a change set, returning it with error set when the update failed.
+
+    Errors of the update, including connection errors, are caught so one
+    environment that is mid-deployment or unreachable doesn't stop the others.
+    """
+    options_to_update = dict(change_set.added)
+    options_to_update.update((key, new) for key, (new, old) in change_set.modified.items())
+    try:
+        response = update_env(client, change_set.ref.app_name, change_set.ref.env_id, options_to_update,
+                              change_set.removed)
+    except (botocore_exceptions.ClientError, botocore_exceptions.BotoCoreError) as e:
+        return change_set._replace(error="update failed: {}".format(e))
+    return change_set._replace(ref=change_set.ref._replace(env_name=response['EnvironmentName']))
+
+
+def print_event(event: dict) -> None:
+    print("{} {} {}: {}".format(event['EventDate'], event.get('EnvironmentName'), event.get('Severity'), event['Message']))
+
+
+def print_wave(number: int, total: int, wave: list) -> None:
+    print("Wave {} of {}: {}".format(number, total, ", ".join(plan.ref.env_id for plan in wave)))
+
+
+def get_events_since(client, start_time, env_id: str = None, app_name: str = None) -> list:
+    """Return events from start_time onwards, of one environment or application when given, oldest first."""
+    params = {'StartTime': start_time}
+    if env_id:
+        params['EnvironmentId'] = env_id
+    elif app_name:
+        params['ApplicationName'] = app_name
+    return sorted(paginate(client.describe_events, 'Events', **params), key=lambda event: event['EventDate'])
+
+
+def wait_for_environments(client, env_ids: list, timeout: int = DEFAULT_WAIT_TIMEOUT, on_event=None,
+                          min_interval: float = 5, max_interval: float = 30, settle_health: bool = False,
+                          start_time: datetime = None) -> dict:
+    """Wait until the environments of one region are Ready, passing their events to on_event as they happen.
+
+    Each poll makes one describe_environments request for all environments still
+    pending and one describe_events request starting at the newest event already
+    seen, so events are never fetched twice. Events are limited to the one
+    environment, or the one application all environments belong to, when there
+    is one. Events start at start_time, which should be taken before the updates
+    are made so their first events aren't missed (default: now).
+    The interval between polls grows while nothing changes and drops back as
+    soon as something does.
+    With settle_health an environment also has to reach Green or Red health, not
+    just the Ready status, before it stops being polled.
+    Returns the last description of every environment keyed by ID; environments
+    that aren't done when the timeout runs out are returned as they were.
+    """
+    pending = set(env_ids)
+    envs = {}
+    cursor = start_time or datetime.now(timezone.utc)
+    seen = set()
+    interval = min_interval
+    deadline = time.monotonic() + timeout
+    while pending:
+        time.sleep(max(0, min(interval, deadline - time.monotonic())))
+        changed = False
+        for env_id, env in describe_environments_by_id(client, pending).items():
+            previous = envs.get(env_id, {})
+            changed |= (previous.get('Status'), previous.get('Health')) != (env.get('Status'), env.get('Health'))
+            envs[env_id] = env
+            if env.get('Status') == 'Ready' and (not settle_health or env.get('Health') in ('Green', 'Red')):
+                pending.discard(env_id)
+        names = {env['EnvironmentName'] for env in envs.values()}
+        single_env = next(iter(env_ids)) if len(env_ids) == 1 else None
+        app_names = {env.get('ApplicationName') for env in envs.values()}
+        single_app = next(iter(app_names)) if len(app_names) == 1 else None
+        for event in get_events_since(client, cursor, single_env, single_app):
+            key = (event['EventDate'], event.get('EnvironmentName'), event['Message'])
+            if key in seen:
+                continue
+            # Move past every event returned, other environments' too, so none is fetched again
+            if event['EventDate'] > cursor:
+                cursor = event['EventDate']
+                seen.clear()
+            seen.add(key)
+            if event.get('EnvironmentName') not in names:
+                continue
+            changed = True
+            if on_event:
+                on_event(event)
+        if time.monotonic() >= deadline:
+            break
+        interval = min_interval if changed else min(max_interval, interval * 1.5)
+    return envs
+
+
+def wait_for_plans(plans: list, timeout: int = DEFAULT_WAIT_TIMEOUT, require_green: bool = False,
+                   start_time: datetime = None, on_event=None) -> dict:
+    """Wait for the environments of the plans, with one shared poller per region.
+
+    start_time is when the plans started being applied and events are passed to
+    on_event, see wait_for_environments.
+    Returns whether each environment became Ready, and Green with require_green,
+    keyed by environment ID.
+    """
+    by_region = {}
+    for plan in plans:
+        by_region.setdefault(plan.ref.region, []).append(plan.ref.env_id)
+    with ThreadPoolExecutor(max_workers=len(by_region) or 1) as executor:
+        results = executor.map(lambda region: wait_for_environments(get_client(region), by_region[region], timeout,
+                                                                    settle_health=require_green,
+                                                                    start_time=start_time, on_event=on_event),
+                               by_region)
+        envs = {env_id: env for region_envs in results for env_id, env in region_envs.items()}
+
+    def is_done(env):
+        return env.get('Status') == 'Ready' and (not require_green or env.get('Health') == 'Green')
+    return {plan.ref.env_id: is_done(envs.get(plan.ref.env_id, {})) for plan in plans}
+
+
+def rolling_apply(plans: list, wave_size: int, timeout: int = DEFAULT_WAIT_TIMEOUT, cache: ConfigCache = None,
+                  on_wave=None, on_event=None) -> dict:
+    """Apply plans in waves of at most wave_size environments restarting at once.
+
+    Each wave starts only after every environment of the previous one is back to
+    Ready with Green health. The rollout stops at the first wave with a failed
+    update or an environment that doesn't get healthy in time. on_wave is called
+    with the wave number, the number of waves and the wave's plans before each
+    wave starts, on_event with the events of the environments being waited on.
+    Returns the ChangeSet of each environment keyed by ID, with error set when it
+    failed or didn't get healthy, None for those never started.
+    """
+    if wave_size < 1:
+        raise ValueError("wave_size must be at least 1, got {}".format(wave_size))
+    results = dict.fromkeys((plan.ref.env_id for plan in plans), None)
+    waves = [plans[start:start + wave_size] for start in range(0, len(plans), wave_size)]
+    for number, wave in enumerate(waves, 1):
+        if on_wave:
+            on_wave(number, len(waves), wave)
+        started = datetime.now(timezone.utc)
+        applied = apply_plans(wave, wave_size, cache)
+        healthy = wait_for_plans([result for result in applied.values() if not result.error], timeout,
+                                 require_green=True, start_time=started, on_event=on_event)
+        for env_id, result in applied.items():
+            if not result.error and not healthy[env_id]:
+                result = result._replace(error="not Ready with Green health after {} seconds".format(timeout))
+            results[env_id] = result
+        if any(results[env_id].error for env_id in applied):
+            break
+    return results
+
+
+def expand_config_paths(paths: list) -> list:
+    """Expand directories in paths to the yml files they contain."""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names) if splitext(name)[1] in ('.yml', '.yaml'))
+    return files
+
+
+def fetch_snapshots(refs: list, concurrency: int = DEFAULT_CONCURRENCY, cache: ConfigCache = None,
+                    errors: dict = None) -> dict:
+    """Fetch the live EnvConfig of many environments at once.
+
+    Refs are grouped by region and each region's live configs are fetched
+    concurrently with one batched environment lookup. Returns a ConfigSnapshot
+    per ref, environments that can't be found are left out. With an errors dict,
+    ClientErrors are collected there keyed by ref instead of being raised.
+    """
+    by_region = {}
+    for ref in refs:
+        by_region.setdefault(ref.region, []).append(ref)
+
+    def fetch_region(region):
+        env_ids = [ref.env_id for ref in by_region[region]]
+        if errors is None:
+            return get_configs(get_client(region), region, env_ids, concurrency, cache)
+        env_errors = {}
+        try:
+            configs = get_configs(get_client(region), region, env_ids, concurrency, cache, env_errors)
+        except botocore_exceptions.ClientError as e:
+            env_errors = dict.fromkeys(env_ids, e)
+            configs = {}
+        errors.update((ref, env_errors[ref.env_id]) for ref in by_region[region] if ref.env_id in env_errors)
+        return configs
+
+    with ThreadPoolExecutor(max_workers=len(by_region) or 1) as executor:
+        live_configs = dict(zip(by_region, executor.map(fetch_region, by_region)))
+
+    fetched_at = datetime.now(timezone.utc)
+    snapshots = {}
+    for ref in refs:
+        live_config = live_configs[ref.region].get(ref.env_id)
+        if live_config is not None:
+            snapshots[ref] = ConfigSnapshot(ref._replace(env_name=live_config.get('EnvironmentName', ref.env_name)),
+                                            live_config['EnvConfig'], fetched_at)
+    return snapshots
+
+
+def plan_updates(file_configs: list, concurrency: int = DEFAULT_CONCURRENCY, cache: ConfigCache = None) -> list:
+    """Plan updates for many config files at once.
+
+    Environments that can't be found or fetched get a ChangeSet with an error and
+    no changes, the others are still planned.
+    """
+    refs = [EnvironmentRef.from_config(file_config) for file_config in file_configs]
+    errors = {}
+    snapshots = fetch_snapshots(refs, concurrency, cache, errors)
+    plans = []
+    for ref, file_config in zip(refs, file_configs):
+        snapshot = snapshots.get(ref)
+        if ref in errors:
+            plan = plan_update(file_config, file_config['EnvConfig'])._replace(
+                error="failed to fetch environment {}: {}".format(ref.env_id, errors[ref]))
+        elif snapshot is None:
+            plan = plan_update(file_config, file_config['EnvConfig'])._replace(
+                error="environment {} not found".format(ref.env_id))
         else:
-            print("Canceling operation")
+            plan = plan_update(file_config, snapshot.env_config)
+        plans.append(plan)
+    return plans
+
+
+def apply_plans(plans: list, concurrency: int = DEFAULT_CONCURRENCY, cache: ConfigCache = None) -> dict:
+    """Apply plans in parallel, returning the ChangeSet of each keyed by environment ID.
+
+    A failed update doesn't stop the others, environments that are mid-deployment
+    or can't be reached are returned with error set.
+    """
+    def apply(plan):
+        result = apply_plan(get_client(plan.ref.region), plan)
+        if cache:
+            cache.invalidate(plan.ref.region, plan.ref.env_id)
+        return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return dict(zip((plan.ref.env_id for plan in plans), executor.map(apply, plans)))
+
+
+def apply_changes(change_sets: list, concurrency: int = DEFAULT_CONCURRENCY, cache: ConfigCache = None,
+                  wave_size: int = None, timeout: int = DEFAULT_WAIT_TIMEOUT, on_wave=None, on_event=None) -> dict:
+    """Apply the change sets that have changes, returning the ChangeSet of each keyed by environment ID.
+
+    Returned change sets have error set when their update failed. With
+    wave_size the updates roll out in health-gated waves, see rolling_apply.
+    """
+    pending = [change_set for change_set in change_sets if change_set.has_changes and not change_set.error]
+    if wave_size is not None:
+        return rolling_apply(pending, wave_size, timeout, cache, on_wave, on_event)
+    return apply_plans(pending, concurrency, cache)
+
+
+def load_config_files(paths: list, resolver: ConfigResolver = None) -> list:
+    """Load and resolve config files, skipping templates found in directories."""
+    resolver = resolver or ConfigResolver()
+    file_configs = []
+    for path in paths:
+        for filename in expand_config_paths([path]):
+            file_config = resolver.resolve(filename)
+            if is_template(file_config):
+                if filename == path:
+                    raise ConfigError("{} has no EnvironmentID".format(filename))
+                continue
+            check_required_keys(filename, file_config)
+            file_config['File'] = filename
+            file_configs.append(file_config)
+    return file_configs
+
+
+def check_config_content(content: bytes) -> dict:
+    """Check one config file on its own, without resolving Extends.
+
+    Returns the file's errors together with what validate needs to check it
+    against the files it extends: its Extends, the required keys it sets and the
+    size in bytes each EnvConfig variable takes (None for variables it removes).
+    Only depends on the content, so results can be cached by content hash.
+    """
+    facts = {'errors': [], 'extends': [], 'keys': {}, 'sizes': {}}
+    errors = facts['errors']
+    try:
+        data = yaml.load(content, Loader=yaml_backend()[0])
+    except yaml.YAMLError as e:
+        errors.append("invalid yaml: {}".format(e))
+        return facts
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        errors.append("expected a mapping at the top level")
+        return facts
+    for key, value in data.items():
+        if key not in CONFIG_KEYS:
+            errors.append("unknown key {!r}".format(key))
+        elif key in REQUIRED_CONFIG_KEYS + ('EnvironmentName',):
+            valid = isinstance(value, str) and value.strip()
+            if not valid:
+                errors.append("{} must be a non-empty string".format(key))
+            if key in REQUIRED_CONFIG_KEYS:
+                facts['keys'][key] = value if valid else None
+    extends = data.get('Extends') or []
+    extends = [extends] if isinstance(extends, str) else extends
+    if not isinstance(extends, list) or not all(isinstance(base, str) for base in extends):
+        errors.append("Extends must be a file name or a list of them")
     else:
-        print("No changes found, environment is up to date")
+        facts['extends'] = extends
+    env_config = data.get('EnvConfig') or {}
+    if not isinstance(env_config, dict):
+        errors.append("EnvConfig must be a mapping of variable names to values")
+        env_config = {}
+    for name, value in env_config.items():
+        if not isinstance(name, str) or not name:
+            errors.append("variable name {!r} is not a string".format(name))
+            continue
+        if name != name.strip():
+            errors.append("variable {!r} has whitespace around its name".format(name))
+        if len(name) > MAX_OPTION_NAME_LENGTH:
+            errors.append("variable {} is longer than {} characters".format(name, MAX_OPTION_NAME_LENGTH))
+        if value is None:
+            facts['sizes'][name] = None
+            continue
+        if not isinstance(value, str):
+            errors.append("variable {} is {!r}, quote it to make it a string".format(name, value))
+            value = str(value)
+        reference = parse_secret_reference(value)
+        if reference and reference[0] not in SECRET_PROVIDERS:
+            errors.append("variable {} uses unknown secret scheme {!r}".format(name, reference[0]))
+        elif not reference and len(value) > MAX_OPTION_VALUE_LENGTH:
+            errors.append("variable {} is longer than {} characters".format(name, MAX_OPTION_VALUE_LENGTH))
+        facts['sizes'][name] = len("{}={}".format(name, value).encode('utf-8'))
+    return facts
+
+
+class ValidationCache:
+    """Results of check_config_content keyed by sha256 of the file content, kept in one json file.
+
+    Entries of files not seen in a run are dropped once there are more than
+    max_entries, so the file stays small however often configs change.
+    """
+
+    def __init__(self, filename: str, max_entries: int = 100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.entries = {}
+        self.seen = {}
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('Version') == VALIDATE_CACHE_VERSION:
+            self.entries = data['Entries']
+
+    def get(self, digest: str):
+        facts = self.entries.get(digest)
+        if facts is not None:
+            self.seen[digest] = facts
+        return facts
+
+    def put(self, digest: str, facts: dict) -> None:
+        self.seen[digest] = facts
+
+    def save(self) -> None:
+        if all(digest in self.entries for digest in self.seen):
+            return
+        entries = dict(self.entries, **self.seen)
+        if len(entries) > self.max_entries:
+            entries = self.seen
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump({'Version': VALIDATE_CACHE_VERSION, 'Entries': entries}, f)
+        os.replace(tmp_filename, self.filename)
+
+
+def extends_paths(path: str, facts: dict) -> list:
+    """Absolute paths of the bases a checked file extends, which are relative to its directory."""
+    return [os.path.abspath(os.path.join(os.path.dirname(path), base)) for base in facts['extends']]
+
+
+def check_config_files(filenames: list, cache: ValidationCache = None, processes: int = None) -> dict:
+    """Run check_config_content over files and the bases they extend, keyed by absolute path.
+
+    Files found in the cache aren't parsed again. When more than
+    VALIDATE_POOL_THRESHOLD are left they are spread over a process pool.
+    """
+    results = {}
+    pending = [os.path.abspath(filename) for filename in filenames]
+    while pending:
+        contents = {}
+        for path in pending:
+            if path in results:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    content = f.read()
+            except OSError as e:
+                results[path] = {'errors': ["can't read file: {}".format(e.strerror)], 'extends': [], 'keys': {},
+                                 'sizes': {}}
+                continue
+            digest = hashlib.sha256(content).hexdigest()
+            facts = cache.get(digest) if cache else None
+            if facts is None:
+                contents[path] = (digest, content)
+            else:
+                results[path] = facts
+        if len(contents) > VALIDATE_POOL_THRESHOLD:
+            # Imported here, multiprocessing would slow down the start of every other run
+            from concurrent.futures import ProcessPoolExecutor
+            workers = processes or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                checked = list(executor.map(check_config_content, (content for digest, content in contents.values()),
+                                            chunksize=max(1, len(contents) // (workers * 4))))
+        else:
+            checked = [check_config_content(content) for digest, content in contents.values()]
+        for (path, (digest, content)), facts in zip(contents.items(), checked):
+            results[path] = facts
+            if cache:
+                cache.put(digest, facts)
+        pending = {base_path for path in set(pending) for base_path in extends_paths(path, results[path])
+                   if base_path not in results}
+    return results
+
+
+def validate_config_files(paths: list, cache: ValidationCache = None, processes: int = None) -> dict:
+    """Check config files offline against the format load_yaml expects and Beanstalk's limits.
+
+    Each file is checked on its own first (see check_config_content), then with
+    its Extends resolved: bases must exist without cycles, files that aren't only
+    extended by others need Region, ApplicationName and EnvironmentID, their
+    merged EnvConfig must fit in MAX_ENV_CONFIG_BYTES and no two can configure
+    the same environment. Returns the errors of every file, keyed by filename.
+    """
+    filenames = expand_config_paths(paths)
+    results = check_config_files(filenames, cache, processes)
+    extended = {base_path for path, facts in results.items() for base_path in extends_paths(path, facts)}
+
+    def merge(path, chain):
+        """Return keys and sizes of path with its bases merged in, and errors about the bases."""
+        keys, sizes, errors = {}, {}, []
+        if path in chain:
+            return keys, sizes, ["circular Extends: {}".format(" -> ".join(chain + (path,)))]
+        facts = results[path]
+        for base, base_path in zip(facts['extends'], extends_paths(path, facts)):
+            if not os.path.exists(base_path):
+                errors.append("Extends {} which doesn't exist".format(base))
+                continue
+            base_keys, base_sizes, base_errors = merge(base_path, chain + (path,))
+            keys.update(base_keys)
+            sizes.update(base_sizes)
+            errors.extend(base_errors)
+        keys.update(facts['keys'])
+        sizes.update(facts['sizes'])
+        return keys, sizes, errors
+
+    report = {}
+    environments = {}
+    for filename in filenames:
+        path = os.path.abspath(filename)
+        errors = list(results[path]['errors'])
+        keys, sizes, base_errors = merge(path, ())
+        errors.extend(error for error in base_errors if error not in errors)
+        if 'EnvironmentID' in keys or path not in extended:
+            missing = [key for key in REQUIRED_CONFIG_KEYS if key not in keys]
+            if missing:
+                errors.append("missing {}".format(", ".join(missing)))
+            total = sum(size for size in sizes.values() if size is not None)
+            if total > MAX_ENV_CONFIG_BYTES:
+                errors.append("EnvConfig takes {} bytes, more than Beanstalk's limit of {}".format(
+                    total, MAX_ENV_CONFIG_BYTES))
+            if keys.get('EnvironmentID'):
+                other = environments.setdefault(keys['EnvironmentID'], filename)
+                if other != filename:
+                    errors.append("{} also configures environment {}".format(other, keys['EnvironmentID']))
+        report[filename] = errors
+    return report
+
+
+def parse_assignments(items: list, with_values: bool = True) -> dict:
+    """Parse NAME=VALUE arguments of set, or NAME arguments of unset (mapped to None)."""
+    assignments = {}
+    for item in items:
+        name, separator, value = item.partition('=')
+        if with_values != bool(separator) or not name or name != name.strip():
+            raise ConfigError("expected {}, got {!r}".format("NAME=VALUE" if with_values else "NAME", item))
+        assignments[name] = value if with_values else None
+    return assignments
+
+
+def select_environments(client, app_name: str = None, name_pattern: str = None, env_id: str = None,
+                        tags: dict = None, concurrency: int = DEFAULT_CONCURRENCY) -> list:
+    """List the live environments of the region that match every given filter.
 
+    name_pattern is a shell-style pattern matched against environment names. Tags
+    need one list_tags_for_resource request per environment, so they are only
+    looked up, concurrently, for environments that pass the other filters.
+    """
+    envs = [env for env in get_environments(client, app_name)
+            if (not name_pattern or fnmatch.fnmatchcase(env['EnvironmentName'], name_pattern))
+            and (not env_id or env['EnvironmentId'] == env_id)]
+    if not tags or not envs:
+        return envs
 
+    def has_tags(env):
+        response = client.list_tags_for_resource(ResourceArn=env['EnvironmentArn'])
+        env_tags = {tag['Key']: tag['Value'] for tag in response['ResourceTags']}
+        return all(env_tags.get(key) == value for key, value in tags.items())
 
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return [env for env, matches in zip(envs, executor.map(has_tags, envs)) if matches]
+
+
+def plan_edits(region: str, assignments: dict, concurrency: int = DEFAULT_CONCURRENCY, cache: ConfigCache = None,
+               **filters) -> list:
+    """Plan setting variables on every environment of the region selected by filters.
+
+    assignments maps names to new values, None removes the variable. Each live
+    config is fetched concurrently and compared with itself after the edit, so
+    the ChangeSet of an environment that already matches has no changes.
+    Environments whose config can't be fetched get a ChangeSet with an error and
+    no changes, the others are still planned.
+    Secret references in values are resolved once for the whole region.
+    """
+    client = get_client(region)
+    edit = {"Region": region, "EnvConfig": {name: value for name, value in assignments.items() if value is not None}}
+    SecretResolver().resolve_configs([edit])
+
+    def fetch(env):
+        try:
+            return env, fetch_config(client, region, env, cache), None
+        except (botocore_exceptions.ClientError, botocore_exceptions.BotoCoreError) as e:
+            return env, None, e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, select_environments(client, concurrency=concurrency, **filters)))
+    plans = []
+    for env, config, error in results:
+        if error:
+            ref = EnvironmentRef(region, env['ApplicationName'], env['EnvironmentId'], env['EnvironmentName'])
+            plans.append(ChangeSet(ref, {}, [], {}, error="failed to fetch environment {}: {}".format(
+                ref.env_id, error)))
+            continue
+        live = config['EnvConfig']
+        desired = {name: value for name, value in live.items() if name not in assignments}
+        desired.update(edit['EnvConfig'])
+        plans.append(diff_config(EnvironmentRef.from_config(config), desired, live, edit.get('SecretKeys', ())))
+    return plans
+
+
+def get_update_plans(args) -> list:
+    file_configs = load_config_files(args.file)
+    seen = {}
+    for file_config in file_configs:
+        if file_config['EnvironmentID'] in seen:
+            raise DuplicateEnvironment("{} and {} both configure environment {}".format(
+                seen[file_config['EnvironmentID']], file_config['File'], file_config['EnvironmentID']))
+        seen[file_config['EnvironmentID']] = file_config['File']
+    SecretResolver().resolve_configs(file_configs)
+    return plan_updates(file_configs, args.concurrency, cache_from_args(args))
+
+
+def action_plan(args) -> int:
+    """Print pending changes as json. Exits with EXIT_CHANGES when there is something to apply."""
+    plans = get_update_plans(args)
+    print(json.dumps([plan.to_dict() for plan in plans], indent=2, sort_keys=True))
+    if any(plan.error for plan in plans):
+        return EXIT_ERROR
+    return EXIT_CHANGES if any(plan.has_changes for plan in plans) else EXIT_OK
+
+
+def action_update(args) -> int:
+    return review_and_apply(args, get_update_plans(args))
+
+
+def review_and_apply(args, plans: list) -> int:
+    """Show the plans with changes, ask for confirmation unless --yes and apply them."""
+    errors = [plan for plan in plans if plan.error]
+    for plan in errors:
+        print("{}: {}".format(plan.source or plan.ref.env_id, plan.error))
+    pending = [plan for plan in plans if plan.has_changes and not plan.error]
+    if not pending:
+        print("No changes found, {} up to date".format("environment is" if len(plans) == 1 else "environments are"))
+        return EXIT_ERROR if errors else EXIT_OK
+    for plan in pending:
+        if len(plans) > 1:
+            print("Application '{}' environment '{}' ({}) in {}:".format(
+                plan.ref.app_name, plan.ref.env_name, plan.ref.env_id, plan.ref.region))
+        print_plan(plan)
+    question = "Update environment?" if len(pending) == 1 else "Update {} environments?".format(len(pending))
+    if not args.yes and input("{} [yes/no]: ".format(question)) != 'yes':
+        print("Canceling operation")
+        return EXIT_CHANGES
+    started = datetime.now(timezone.utc)
+    results = apply_changes(pending, args.concurrency, cache_from_args(args), args.wave_size, args.timeout,
+                            on_wave=print_wave, on_event=print_event)
+    applied = [result for result in results.values() if result and not result.error]
+    failed = [result for result in results.values() if result and result.error]
+    skipped = [env_id for env_id, result in results.items() if result is None]
+    for result in applied:
+        print("Update SUCCESSFUL. Application '{}' environment '{}' is restarting".format(
+            result.ref.app_name, result.ref.env_name))
+    if len(pending) == 1 and failed and not args.wave_size:
+        print(failed[0].error)
+        print()
+        print("NO CHANGES MADE. Please run the script again when environment state changes")
+    if args.wave_size or len(pending) > 1:
+        print("Updated {} of {} environments".format(len(applied), len(pending)))
+        for result in failed:
+            print("\tFAILED: {}: {}".format(result.ref.env_id, result.error))
+        for env_id in skipped:
+            print("\tNOT STARTED: {}".format(env_id))
+    failed = [result.ref.env_id for result in failed] + skipped
+    if args.wait and not args.wave_size:
+        ready = wait_for_plans(applied, args.timeout, start_time=started, on_event=print_event)
+        not_ready = [env_id for env_id, is_ready in ready.items() if not is_ready]
+        for env_id in not_ready:
+            print("Environment {} is not Ready after {} seconds".format(env_id, args.timeout))
+        failed.extend(not_ready)
+    return EXIT_ERROR if failed or errors else EXIT_OK
+
+
+def print_drift(plan: ChangeSet) -> None:
+    plan = plan.masked()
+    name = "'{}' ({})".format(plan.ref.env_name, plan.ref.env_id)
+    if not plan.has_changes:
+        print("Environment {} matches {} again".format(name, plan.source))
+        return
+    print("Environment {} has drifted from {}:".format(name, plan.source))
+    for key in plan.added:
+        print("\tmissing from environment: {}".format(key))
+    for key in plan.removed:
+        print("\tonly in environment: {}".format(key))
+    for key, (new, old) in plan.modified.items():
+        print("\tchanged: {}: {} -> {}".format(key, new, old))
 
-def main():
-    parser = argparse.ArgumentParser(description='Process some integers.')
-    parser.add_argument('action', choices=["get", "update"])
-    parser.add_argument('file', nargs='?')
+
+def watch(paths: list, interval: int = DEFAULT_WATCH_INTERVAL, iterations: int = None, report=print_drift) -> None:
+    """Keep comparing config files with their live environments, reporting drift when it changes.
+
+    Each round checks every environment once, spread evenly over `interval` so
+    requests don't all land at once. A check describes the environment and only
+    fetches its settings again when DateUpdated has moved since the last round,
+    so an unchanged environment costs one request per round.
+    """
+    store = ConfigFileStore(paths)
+    secrets = SecretResolver()
+    live = {}
+    reported = {}
+    rounds = 0
+    while iterations is None or rounds < iterations:
+        file_configs = store.refresh()
+        try:
+            secrets.resolve_configs(file_configs)
+        except (SecretError, botocore_exceptions.ClientError) as e:
+            print("Failed to resolve secrets: {}".format(e))
+            file_configs = [config for config in file_configs
+                            if not any(map(parse_secret_reference, config['EnvConfig'].values()))]
+        slot = interval / max(len(file_configs), 1)
+        for file_config in file_configs:
+            started = time.monotonic()
+            env_id = file_config['EnvironmentID']
+            try:
+                client = get_client(file_config['Region'])
+                env = describe_environment(client, file_config['ApplicationName'], env_id)
+                if env_id not in live or live[env_id][0] != env.get('DateUpdated'):
+                    live[env_id] = (env.get('DateUpdated'), get_environment_variables(client, env))
+            except (botocore_exceptions.ClientError, botocore_exceptions.BotoCoreError, EnvironmentNotFound) as e:
+                print("Failed to check environment {} from {}: {!r}".format(env_id, file_config['File'], e))
+            else:
+                plan = plan_update(file_config, live[env_id][1])
+                last = reported.get(env_id)
+                if (last is not None or plan.has_changes) and last != plan:
+                    report(plan)
+                    reported[env_id] = plan
+            time.sleep(max(0, slot - (time.monotonic() - started)))
+        rounds += 1
+
+
+def action_edit(args) -> int:
+    """set and unset variables on every environment matching --app-name, --env-pattern, --env-id and --tag."""
+    assignments = parse_assignments(args.file, with_values=args.action == 'set')
+    filters = {'app_name': args.app_name, 'name_pattern': args.env_pattern, 'env_id': args.env_id,
+               'tags': parse_assignments(args.tag or [])}
+    if not any(filters.values()):
+        print("{} requires --app-name, --env-pattern, --env-id or --tag to select environments".format(args.action))
+        return EXIT_ERROR
+    regions = args.regions or [args.region]
+    cache = cache_from_args(args)
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        results = executor.map(lambda region: plan_edits(region, assignments, args.concurrency, cache, **filters),
+                               regions)
+        plans = [plan for region_plans in results for plan in region_plans]
+    if not plans:
+        print("No environments match")
+        return EXIT_ERROR
+    unchanged = [plan for plan in plans if not plan.has_changes and not plan.error]
+    if unchanged:
+        print("Skipping {} of {} environments that already match".format(len(unchanged), len(plans)))
+    return review_and_apply(args, plans)
+
+
+def action_watch(args) -> int:
+    try:
+        watch(args.file, args.interval)
+    except KeyboardInterrupt:
+        pass
+    return EXIT_OK
+
+
+SNAPSHOT_SCHEMA = """
+CREATE TABLE environments (
+    environment_id TEXT PRIMARY KEY,
+    region TEXT NOT NULL,
+    application_name TEXT NOT NULL,
+    environment_name TEXT NOT NULL,
+    fetched_at TEXT NOT NULL
+);
+CREATE TABLE variables (
+    environment_id TEXT NOT NULL REFERENCES environments(environment_id),
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (environment_id, name)
+) WITHOUT ROWID;
+CREATE INDEX variables_name_value ON variables (name, value);
+"""
+
+
+def export_snapshot(filename: str, configs: list) -> None:
+    """Write (config, fetched_at) pairs into a new SQLite snapshot, replacing filename once it is complete."""
+    with PROFILER.span('write') as span:
+        tmp_filename = filename + '.tmp'
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        connection = sqlite3.connect(tmp_filename)
+        try:
+            with connection:
+                connection.executescript(SNAPSHOT_SCHEMA)
+                connection.executemany("INSERT INTO environments VALUES (?, ?, ?, ?, ?)", (
+                    (config['EnvironmentID'], config['Region'], config['ApplicationName'], config['EnvironmentName'],
+                     fetched_at.isoformat()) for config, fetched_at in configs))
+                connection.executemany("INSERT INTO variables VALUES (?, ?, ?)", (
+                    (config['EnvironmentID'], name, str(value))
+                    for config, fetched_at in configs for name, value in config['EnvConfig'].items()))
+        finally:
+            connection.close()
+        os.replace(tmp_filename, filename)
+        span['bytes'] = os.path.getsize(filename)
+
+
+def query_snapshot(filename: str, name: str, value: str = None) -> list:
+    """Find environments in a snapshot that set variable name, optionally only to value.
+
+    Returns (region, application name, environment name, environment ID, value) rows.
+    """
+    sql = ("SELECT e.region, e.application_name, e.environment_name, e.environment_id, v.value "
+           "FROM variables v JOIN environments e USING (environment_id) WHERE v.name = ?")
+    params = [name]
+    if value is not None:
+        sql += " AND v.value = ?"
+        params.append(value)
+    connection = sqlite3.connect('file:{}?mode=ro'.format(filename), uri=True)
+    try:
+        return connection.execute(sql + " ORDER BY e.region, e.application_name, e.environment_name", params).fetchall()
+    finally:
+        connection.close()
+
+
+def action_export(args) -> int:
+    configs = []
+    failed = 0
+    for region, results in get_all_region_configs(args.regions or [args.region], args.concurrency,
+                                                  cache_from_args(args)).items():
+        for env, config, fetched_at, error in results:
+            if error:
+                failed += 1
+                print("Failed to get config for {} ({}): {}".format(env['EnvironmentName'], env['EnvironmentId'], error))
+            else:
+                configs.append((config, fetched_at))
+    export_snapshot(args.file[0], configs)
+    print("Exported {} environments to {}".format(len(configs), args.file[0]))
+    return EXIT_ERROR if failed else EXIT_OK
+
+
+def action_query(args) -> int:
+    if not args.variable:
+        print("query requires --variable")
+        return EXIT_ERROR
+    try:
+        rows = query_snapshot(args.file[0], args.variable, args.value)
+    except sqlite3.Error as e:
+        print("can't read snapshot {}: {}".format(args.file[0], e))
+        return EXIT_ERROR
+    for region, app_name, env_name, env_id, value in rows:
+        print("{} {} {} ({}): {}={}".format(region, app_name, env_name, env_id, args.variable, value))
+    return EXIT_OK
+
+
+def action_validate(args) -> int:
+    cache = None
+    if args.cache_dir and not args.no_cache:
+        cache = ValidationCache(os.path.join(args.cache_dir, 'validate.json'))
+    report = validate_config_files(args.file, cache)
+    if cache:
+        cache.save()
+    invalid = [filename for filename, errors in report.items() if errors]
+    for filename in invalid:
+        for error in report[filename]:
+            print("{}: {}".format(filename, error))
+    print("Checked {} files, {} with errors".format(len(report), len(invalid)))
+    return EXIT_ERROR if invalid else EXIT_OK
+
+
+def cache_from_args(args):
+    if args.no_cache or not args.cache_dir:
+        return None
+    return ConfigCache(args.cache_dir, args.cache_ttl, args.refresh)
+
+
+def positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got {}".format(value))
+    return number
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    """argparse exits with 2 on usage errors, which would read as EXIT_CHANGES; exit with EXIT_ERROR instead."""
+
+    def error(self, message):
+        self.print_usage(sys.stderr)
+        self.exit(EXIT_ERROR, "{}: error: {}\n".format(self.prog, message))
+
+
+def main(argv=None) -> int:
+    global RATE_LIMIT
+    parser = ArgumentParser(description='Manage AWS ElasticBeanstalk environment variables with yml files.')
+    parser.add_argument('action', choices=["get", "update", "plan", "apply", "watch", "export", "query",
+                                           "validate", "set", "unset"],
+                        help="plan prints pending changes as json, apply is update that never prompts and "
+                             "requires --yes, "
+                             "watch keeps reporting drift between config files and live environments, "
+                             "export saves every environment's config to a snapshot file that query searches, "
+                             "validate checks config files without calling AWS, "
+                             "set and unset edit variables of every selected environment")
+    parser.add_argument('file', nargs='*', help="config files or directories of them, the snapshot file, "
+                                                     "or NAME=VALUE pairs for set and NAMEs for unset")
     parser.add_argument('--app-name')
     parser.add_argument('--env-id')
     parser.add_argument('--region')
+    parser.add_argument('--regions', type=lambda value: value.split(','),
+                        help="comma separated list of regions to run get --all and export across concurrently")
+    parser.add_argument('--env-pattern', help="shell-style pattern of environment names for set and unset")
+    parser.add_argument('--tag', action='append',
+                        help="KEY=VALUE tag environments must have for set and unset, can be repeated")
     parser.add_argument('--out-file')
-    args = parser.parse_args()
+    parser.add_argument('--all', action='store_true', help="get configs of all environments in the region")
+    parser.add_argument('--out-dir', default='.', help="directory to save configs to when using --all")
+    parser.add_argument('--concurrency', type=positive_int, default=DEFAULT_CONCURRENCY,
+                        help="maximum number of concurrent API requests and environment updates")
+    parser.add_argument('--cache-dir', default=os.environ.get('BEANSTALKER_CACHE_DIR'),
+                        help="directory to cache live environment configs in (default: $BEANSTALKER_CACHE_DIR)")
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL,
+                        help="seconds a cached config stays valid")
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the config cache")
+    parser.add_argument('--refresh', action='store_true', help="ignore cached configs and fetch them again")
+    parser.add_argument('--wait', action='store_true',
+                        help="after updating, wait for environments to be Ready and print their events")
+    parser.add_argument('--timeout', type=int, default=DEFAULT_WAIT_TIMEOUT,
+                        help="seconds to wait for environments with --wait")
+    parser.add_argument('--wave-size', type=positive_int,
+                        help="update environments in waves of this many, each waiting for the previous to be healthy")
+    parser.add_argument('--interval', type=int, default=DEFAULT_WATCH_INTERVAL,
+                        help="seconds watch takes to check every environment once")
+    parser.add_argument('--variable', help="variable name to look up with query")
+    parser.add_argument('--value', help="only match environments where --variable is set to this value")
+    parser.add_argument('--max-rate', type=float, default=RATE_LIMIT,
+                        help="maximum API requests per second to each region, lowered automatically when throttled")
+    parser.add_argument('--stats', action='store_true', help="print API call, retry and throttling counts at exit")
+    parser.add_argument('--profile', action='store_true',
+                        help="print a table of API call and pipeline stage timings at exit")
+    parser.add_argument('--profile-json', help="append every timing span to this file as a json line")
+    parser.add_argument('--yes', '-y', action='store_true', help="never prompt; apply changes without confirmation")
+    args = parser.parse_args(argv)
+
+    if not args.file and args.action != 'get':
+        expected = {'set': "NAME=VALUE arguments", 'unset': "NAME arguments"}.get(args.action, "a file argument")
+        parser.error("{} requires {}".format(args.action, expected))
+    if args.action == 'apply' and not args.yes:
+        parser.error("apply never prompts, it requires --yes")
+
+    RATE_LIMIT = args.max_rate
+    profile_stream = open(args.profile_json, 'a') if args.profile_json else None
+    if args.profile or profile_stream:
+        PROFILER.enable(profile_stream)
+    try:
+        return run_action(args)
+    finally:
+        if args.stats:
+            print(METRICS.summary(), file=sys.stderr)
+        if args.profile:
+            print(PROFILER.summary(), file=sys.stderr)
+        if profile_stream:
+            profile_stream.close()
+
+
+def run_action(args) -> int:
+    if args.action == 'get' and args.all:
+        return action_get_all(args.regions or [args.region], args.out_dir, args.concurrency, cache_from_args(args))
+    elif args.action == 'get':
+        return action_get(args.region, args.app_name, args.env_id, args.out_file, interactive=not args.yes)
+    try:
+        if args.action == 'plan':
+            return action_plan(args)
+        if args.action == 'watch':
+            return action_watch(args)
+        if args.action == 'export':
+            return action_export(args)
+        if args.action == 'query':
+            return action_query(args)
+        if args.action == 'validate':
+            return action_validate(args)
+        if args.action in ('set', 'unset'):
+            return action_edit(args)
+        return action_update(args)
+    except ConfigError as e:
+        print(e)
+        return EXIT_ERROR
 
-    if args.action == 'get':
-        action_get(args.region, args.app_name, args.env_id, args.out_file)
-    elif args.action == 'update':
-        action_update(args)
-    else:
-        print("unknown action")
-        
-        os.exit(1)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
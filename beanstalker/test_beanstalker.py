@@ -1,10 +1,60 @@
-from unittest import TestCase
-from datetime import datetime
+from unittest import TestCase, mock
+from datetime import datetime, timedelta, timezone
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
 from beanstalker import beanstalker
 import boto3
+import botocore.exceptions
 from botocore.stub import Stubber
 
 
+def config_settings_response(env_vars: dict) -> dict:
+    return {
+        'ConfigurationSettings': [
+            {
+                'OptionSettings': [
+                    {
+                        'Namespace': 'aws:elasticbeanstalk:application:environment',
+                        'OptionName': name,
+                        'Value': value
+                    } for name, value in env_vars.items()
+                ]
+            },
+        ]
+    }
+
+
+def write_config_file(directory: str, env_config: dict, env_id: str = "e-1", name: str = "config.yml",
+                      region: str = "us-east-1") -> str:
+    filename = os.path.join(directory, name)
+    beanstalker.save_yaml(filename, {
+        "ApplicationName": "app1",
+        "Region": region,
+        "EnvironmentID": env_id,
+        "EnvironmentName": "app1-dev",
+        "EnvConfig": env_config,
+    })
+    return filename
+
+
+class LocalSecretProvider:
+    """Stand-in for a key provider, resolving references from a dict and recording each batch."""
+
+    batches = []
+
+    def __init__(self, region: str):
+        self.region = region
+
+    def resolve(self, references: list) -> dict:
+        self.batches.append((self.region, references))
+        return {reference: "plain-" + reference for reference in references if reference != "missing"}
+
+
 class TestBeanstalker(TestCase):
 
     testDict1 = {
@@ -18,6 +68,11 @@ class TestBeanstalker(TestCase):
         "param8": "val8",
         "param9": "val9",
     }
+    def setUp(self):
+        beanstalker.reset_clients()
+        beanstalker.METRICS.reset()
+        beanstalker.PROFILER.reset()
+
     def get_stub_client(self):
         client = boto3.client('elasticbeanstalk')
         return client
@@ -131,13 +186,844 @@ class TestBeanstalker(TestCase):
         self.assertEqual(len(env_config), 1)
         self.assertEqual(env_config['envoption1'], 'envval1')
 
+    def test_get_all_configs(self):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {
+            "Environments": [
+                {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1"},
+                {"ApplicationName": "app2", "EnvironmentName": "app2-prod", "EnvironmentId": "e-2"},
+                {"ApplicationName": "app2", "EnvironmentName": "app2-old", "EnvironmentId": "e-3",
+                 "Status": "Terminating"},
+            ]
+        }, {"IncludeDeleted": False})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "1"}),
+                             {"ApplicationName": "app1", "EnvironmentName": "app1-dev"})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "2"}),
+                             {"ApplicationName": "app2", "EnvironmentName": "app2-prod"})
+        stubber.activate()
+        results = beanstalker.get_all_configs(client, "us-east-1", concurrency=1)
+        stubber.assert_no_pending_responses()
+        configs = {config['EnvironmentID']: config for env, config, fetched_at, error in results}
+        self.assertEqual(configs['e-1']['EnvConfig'], {"A": "1"})
+        self.assertEqual(configs['e-2']['EnvironmentName'], "app2-prod")
+        self.assertEqual(configs['e-2']['Region'], "us-east-1")
+        self.assertEqual(beanstalker.API_CALLS, {"DescribeEnvironments": 1, "DescribeConfigurationSettings": 2})
 
+    def test_get_environments_follows_next_token(self):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {
+            "Environments": [{"EnvironmentName": "app1-dev", "EnvironmentId": "e-1"}], "NextToken": "page2"
+        }, {"ApplicationName": "app1", "IncludeDeleted": False})
+        stubber.add_response("describe_environments", {
+            "Environments": [{"EnvironmentName": "app1-prd", "EnvironmentId": "e-2"}]
+        }, {"ApplicationName": "app1", "IncludeDeleted": False, "NextToken": "page2"})
+        stubber.activate()
+        envs = beanstalker.get_environments(client, "app1")
+        self.assertEqual(next(envs)["EnvironmentId"], "e-1")
+        self.assertEqual(beanstalker.API_CALLS, {"DescribeEnvironments": 1})
+        self.assertEqual([env["EnvironmentId"] for env in envs], ["e-2"])
+        stubber.assert_no_pending_responses()
+
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_request_layer_retries_throttled(self, sleep):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_client_error("describe_applications", service_error_code="Throttling")
+        stubber.add_response("describe_applications", {"Applications": [{"ApplicationName": "app1"}]})
+        stubber.activate()
+        self.assertEqual(list(beanstalker.get_applications(client)), ["app1"])
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(beanstalker.API_CALLS, {"DescribeApplications": 2})
+        self.assertEqual(beanstalker.METRICS.retries, {"DescribeApplications": 1})
+        self.assertEqual(beanstalker.METRICS.throttles, {"DescribeApplications": 1})
 
+    def test_request_layer_other_error(self):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_client_error("describe_applications", service_error_code="InvalidParameterValue")
+        stubber.activate()
+        with self.assertRaises(beanstalker.botocore_exceptions.ClientError):
+            list(beanstalker.get_applications(client))
 
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_request_layer_retries_transient_errors_of_reads_only(self, sleep):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_client_error("describe_applications", service_error_code="InternalFailure", http_status_code=500)
+        stubber.add_response("describe_applications", {"Applications": []})
+        stubber.add_client_error("update_environment", service_error_code="InternalFailure", http_status_code=500)
+        stubber.activate()
+        self.assertEqual(list(beanstalker.get_applications(client)), [])
+        with self.assertRaises(beanstalker.botocore_exceptions.ClientError):
+            client.update_environment(ApplicationName="app1", EnvironmentId="e-1")
+        stubber.assert_no_pending_responses()
+        self.assertEqual(beanstalker.METRICS.retries, {"DescribeApplications": 1})
 
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_token_bucket(self, sleep):
+        bucket = beanstalker.TokenBucket(rate=2)
+        with mock.patch('beanstalker.beanstalker.time.monotonic', return_value=bucket.updated):
+            self.assertEqual(bucket.acquire(), 0)
+            self.assertEqual(bucket.acquire(), 0)
+            self.assertAlmostEqual(bucket.acquire(), 0.5)
+        sleep.assert_called_once_with(0.5)
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 1)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 2)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 2)
 
+    def test_get_client_reused_per_region(self):
+        client = beanstalker.get_client("us-east-1")
+        self.assertIs(beanstalker.get_client("us-east-1"), client)
+        self.assertIsNot(beanstalker.get_client("eu-west-1"), client)
+        self.assertEqual(beanstalker.get_client("eu-west-1").meta.region_name, "eu-west-1")
+
+    def test_get_config_call_count(self):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {
+            "Environments": [{"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1"}]
+        }, {"ApplicationName": "app1", "EnvironmentIds": ["e-1"]})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "1"}),
+                             {"ApplicationName": "app1", "EnvironmentName": "app1-dev"})
+        stubber.activate()
+        config = beanstalker.get_config(client, "us-east-1", "app1", "e-1")
+        self.assertEqual(config['EnvConfig'], {"A": "1"})
+        self.assertEqual(beanstalker.API_CALLS, {"DescribeEnvironments": 1, "DescribeConfigurationSettings": 1})
+
+    def test_get_configs_batched(self):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {
+            "Environments": [
+                {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1"},
+                {"ApplicationName": "app2", "EnvironmentName": "app2-dev", "EnvironmentId": "e-2"},
+            ]
+        }, {"EnvironmentIds": ["e-1", "e-2", "e-3"]})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "1"}),
+                             {"ApplicationName": "app1", "EnvironmentName": "app1-dev"})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"B": "2"}),
+                             {"ApplicationName": "app2", "EnvironmentName": "app2-dev"})
+        stubber.activate()
+        configs = beanstalker.get_configs(client, "us-east-1", ["e-1", "e-2", "e-3"], concurrency=1)
+        self.assertEqual(sorted(configs), ["e-1", "e-2"])
+        self.assertEqual(configs['e-2']['ApplicationName'], "app2")
+        self.assertEqual(configs['e-2']['EnvConfig'], {"B": "2"})
+        self.assertEqual(beanstalker.API_CALLS, {"DescribeEnvironments": 1, "DescribeConfigurationSettings": 2})
+
+    def test_config_cache(self):
+        env = {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1",
+               "DateUpdated": datetime(2018, 1, 1)}
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = beanstalker.ConfigCache(cache_dir, ttl=60)
+            self.assertIsNone(cache.get("us-east-1", env))
+            cache.put("us-east-1", env, {"A": "1"})
+            self.assertEqual(cache.get("us-east-1", env), {"A": "1"})
+            self.assertEqual(os.stat(os.path.join(cache_dir, "us-east-1")).st_mode & 0o777, 0o700)
+            self.assertEqual(os.stat(os.path.join(cache_dir, "us-east-1", "e-1.json")).st_mode & 0o777, 0o600)
+            self.assertIsNone(cache.get("us-east-1", dict(env, DateUpdated=datetime(2018, 1, 2))))
+            self.assertIsNone(beanstalker.ConfigCache(cache_dir, ttl=60, refresh=True).get("us-east-1", env))
+            with mock.patch('beanstalker.beanstalker.time.time', return_value=datetime.now().timestamp() + 61):
+                self.assertIsNone(cache.get("us-east-1", env))
+            cache.invalidate("us-east-1", "e-1")
+            self.assertIsNone(cache.get("us-east-1", env))
+
+    def test_get_config_cached(self):
+        client = beanstalker.get_client()
+        env_response = {"Environments": [{"ApplicationName": "app1", "EnvironmentName": "app1-dev",
+                                          "EnvironmentId": "e-1", "DateUpdated": datetime(2018, 1, 1)}]}
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", env_response)
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "1"}))
+        stubber.add_response("describe_environments", env_response)
+        stubber.activate()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = beanstalker.ConfigCache(cache_dir)
+            first = beanstalker.get_config(client, "us-east-1", "app1", "e-1", cache)
+            second = beanstalker.get_config(client, "us-east-1", "app1", "e-1", cache)
+        self.assertEqual(first, second)
+        stubber.assert_no_pending_responses()
+        self.assertEqual(beanstalker.API_CALLS, {"DescribeEnvironments": 2, "DescribeConfigurationSettings": 1})
+
+    def stub_live_config(self, stubber, env_vars: dict, env_id: str = "e-1"):
+        stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": env_id}]})
+        stubber.add_response("describe_configuration_settings", config_settings_response(env_vars))
+
+    def test_plan_update(self):
+        file_config = {"ApplicationName": "app1", "Region": "us-east-1", "EnvironmentID": "e-1",
+                       "EnvConfig": {"A": "1", "B": "new", "D": "4"}}
+        plan = beanstalker.plan_update(file_config, {"A": "1", "B": "old", "C": "3"})
+        self.assertTrue(plan.has_changes)
+        self.assertEqual(plan.ref, beanstalker.EnvironmentRef("us-east-1", "app1", "e-1"))
+        self.assertEqual(plan.added, {"D": "4"})
+        self.assertEqual(plan.removed, ["C"])
+        self.assertEqual(plan.modified, {"B": ("new", "old")})
+        self.assertEqual(plan.to_dict()["Modified"], {"B": {"Old": "old", "New": "new"}})
+        self.assertFalse(beanstalker.plan_update(file_config, file_config["EnvConfig"]).has_changes)
+
+    def test_library_fetch_diff_apply(self):
+        stubber = Stubber(beanstalker.get_client("us-east-1"))
+        self.stub_live_config(stubber, {"A": "2", "B": "1"})
+        stubber.add_response("update_environment", {
+            "EnvironmentName": "app1-dev", "ResponseMetadata": {"HTTPStatusCode": 200}}, {
+            "ApplicationName": "app1", "EnvironmentId": "e-1",
+            "OptionSettings": [beanstalker.create_env_option("A", "1")]})
+        stubber.activate()
+        ref = beanstalker.EnvironmentRef("us-east-1", "app1", "e-1")
+        missing = beanstalker.EnvironmentRef("us-east-1", "app1", "e-2")
+        snapshots = beanstalker.fetch_snapshots([ref, missing], concurrency=1)
+        self.assertEqual(list(snapshots), [ref])
+        self.assertEqual(snapshots[ref].ref.env_name, "app1-dev")
+        change_set = beanstalker.diff_config(snapshots[ref].ref, {"A": "1", "B": "1"}, snapshots[ref].env_config)
+        unchanged = beanstalker.diff_config(ref, {"A": "2"}, {"A": "2"})
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            results = beanstalker.apply_changes([change_set, unchanged], concurrency=1)
+        stubber.assert_no_pending_responses()
+        self.assertEqual(list(results), ["e-1"])
+        self.assertIsNone(results["e-1"].error)
+        self.assertEqual(results["e-1"].modified, {"A": ("1", "2")})
+        self.assertEqual(stdout.getvalue(), "")
+
+    def test_main_plan_exit_codes(self):
+        stubber = Stubber(beanstalker.get_client("us-east-1"))
+        self.stub_live_config(stubber, {"A": "1"})
+        self.stub_live_config(stubber, {"A": "2"})
+        stubber.activate()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_config_file(directory, {"A": "1"})
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                self.assertEqual(beanstalker.main(["plan", filename]), beanstalker.EXIT_OK)
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                self.assertEqual(beanstalker.main(["plan", filename]), beanstalker.EXIT_CHANGES)
+        plan = json.loads(stdout.getvalue())
+        self.assertEqual(plan[0]["Modified"], {"A": {"Old": "2", "New": "1"}})
+
+    def test_plan_updates_reports_fetch_errors_per_environment(self):
+        stubber = Stubber(beanstalker.get_client("us-east-1"))
+        stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1"},
+            {"ApplicationName": "app2", "EnvironmentName": "app2-dev", "EnvironmentId": "e-2"}]})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "2"}))
+        stubber.add_client_error("describe_configuration_settings", service_error_code="AccessDenied",
+                                 http_status_code=403)
+        stubber.activate()
+        file_configs = [{"ApplicationName": "app{}".format(idx), "Region": "us-east-1",
+                         "EnvironmentID": "e-{}".format(idx), "EnvConfig": {"A": "1"}} for idx in (1, 2)]
+        plans = beanstalker.plan_updates(file_configs, concurrency=1)
+        stubber.assert_no_pending_responses()
+        self.assertIsNone(plans[0].error)
+        self.assertEqual(plans[0].modified, {"A": ("1", "2")})
+        self.assertIn("AccessDenied", plans[1].error)
+        self.assertFalse(plans[1].has_changes)
+
+    def test_main_get_all_fails_when_any_environment_fails(self):
+        stubber = Stubber(beanstalker.get_client("us-east-1"))
+        stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1"},
+            {"ApplicationName": "app1", "EnvironmentName": "app1-stg", "EnvironmentId": "e-2"}]})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "1"}))
+        stubber.add_client_error("describe_configuration_settings", service_error_code="AccessDenied",
+                                 http_status_code=403)
+        stubber.activate()
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                exit_code = beanstalker.main(["get", "--all", "--region", "us-east-1", "--out-dir", directory,
+                                              "--concurrency", "1"])
+        self.assertEqual(exit_code, beanstalker.EXIT_ERROR)
+        self.assertIn("Saved 1 of 2 environments", stdout.getvalue())
+
+    def test_main_usage_errors_are_not_exit_changes(self):
+        for argv in (["plan", "--no-such-flag"], ["plan"], ["apply", "config.yml"]):
+            with mock.patch('sys.stderr', new_callable=io.StringIO), self.assertRaises(SystemExit) as raised:
+                beanstalker.main(argv)
+            self.assertEqual(raised.exception.code, beanstalker.EXIT_ERROR)
+        with tempfile.TemporaryDirectory() as directory, mock.patch('builtins.open') as open_:
+            with mock.patch('sys.stderr', new_callable=io.StringIO), self.assertRaises(SystemExit):
+                beanstalker.main(["plan", "--profile-json", os.path.join(directory, "spans.json")])
+        open_.assert_not_called()
+
+    @mock.patch('builtins.input', side_effect=AssertionError("prompted"))
+    def test_main_apply_yes(self, _input):
+        stubber = Stubber(beanstalker.get_client("us-east-1"))
+        self.stub_live_config(stubber, {"A": "2"})
+        stubber.add_response("update_environment", {
+            "EnvironmentName": "app1-dev", "ResponseMetadata": {"HTTPStatusCode": 200}}, {
+            "ApplicationName": "app1", "EnvironmentId": "e-1",
+            "OptionSettings": [beanstalker.create_env_option("A", "1")]})
+        stubber.activate()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_config_file(directory, {"A": "1"})
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                self.assertEqual(beanstalker.main(["apply", filename, "--yes"]), beanstalker.EXIT_OK)
+        stubber.assert_no_pending_responses()
 
+    @mock.patch('builtins.input', return_value='yes')
+    def test_main_update_many_files(self, _input):
+        us_stubber = Stubber(beanstalker.get_client("us-east-1"))
+        us_stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1"},
+            {"ApplicationName": "app1", "EnvironmentName": "app1-stg", "EnvironmentId": "e-2"}]},
+            {"EnvironmentIds": ["e-1", "e-2"]})
+        us_stubber.add_response("describe_configuration_settings", config_settings_response({"A": "old"}))
+        us_stubber.add_response("describe_configuration_settings", config_settings_response({"A": "1"}))
+        us_stubber.add_response("update_environment", {
+            "EnvironmentName": "app1-dev", "ResponseMetadata": {"HTTPStatusCode": 200}})
+        eu_stubber = Stubber(beanstalker.get_client("eu-west-1"))
+        eu_stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-prd", "EnvironmentId": "e-3"}]},
+            {"EnvironmentIds": ["e-3"]})
+        eu_stubber.add_response("describe_configuration_settings", config_settings_response({"A": "old"}))
+        eu_stubber.add_client_error("update_environment", service_error_code="InvalidParameterValue")
+        us_stubber.activate()
+        eu_stubber.activate()
+        with tempfile.TemporaryDirectory() as directory:
+            write_config_file(directory, {"A": "1"}, "e-1", "dev.yml")
+            write_config_file(directory, {"A": "1"}, "e-2", "stg.yml")
+            write_config_file(directory, {"A": "1"}, "e-3", "prd.yml", region="eu-west-1")
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                exit_code = beanstalker.main(["update", directory, "--concurrency", "1"])
+        self.assertEqual(exit_code, beanstalker.EXIT_ERROR)
+        us_stubber.assert_no_pending_responses()
+        eu_stubber.assert_no_pending_responses()
+        self.assertEqual(_input.call_count, 1)
+        self.assertIn("Updated 1 of 2 environments", stdout.getvalue())
+        self.assertIn("FAILED: e-3", stdout.getvalue())
 
+    def test_main_update_duplicate_environment(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = write_config_file(directory, {"A": "1"}, "e-1", "first.yml")
+            second = write_config_file(directory, {"A": "2"}, "e-1", "second.yml")
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                self.assertEqual(beanstalker.main(["plan", first, second]), beanstalker.EXIT_ERROR)
 
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_wait_for_environments(self, sleep):
+        client = beanstalker.get_client()
+        now = datetime.now(timezone.utc)
+        first = {"EventDate": now + timedelta(seconds=1), "EnvironmentName": "app1-dev", "Message": "updating"}
+        second = {"EventDate": now + timedelta(seconds=2), "EnvironmentName": "app1-dev", "Message": "done"}
+        other = {"EventDate": now + timedelta(seconds=2), "EnvironmentName": "app2-dev", "Message": "other env"}
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {"Environments": [
+            {"EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Updating"},
+            {"EnvironmentName": "app1-stg", "EnvironmentId": "e-2", "Status": "Ready"}]})
+        stubber.add_response("describe_events", {"Events": [first]})
+        stubber.add_response("describe_environments", {"Environments": [
+            {"EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Ready"}]},
+            {"EnvironmentIds": ["e-1"]})
+        stubber.add_response("describe_events", {"Events": [other, second, first]},
+                             {"StartTime": first["EventDate"]})
+        stubber.activate()
+        events = []
+        envs = beanstalker.wait_for_environments(client, ["e-1", "e-2"], on_event=events.append)
+        stubber.assert_no_pending_responses()
+        self.assertEqual([event["Message"] for event in events], ["updating", "done"])
+        self.assertEqual({env_id: env["Status"] for env_id, env in envs.items()}, {"e-1": "Ready", "e-2": "Ready"})
+        self.assertEqual(beanstalker.API_CALLS, {"DescribeEnvironments": 2, "DescribeEvents": 2})
+
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_wait_for_environments_moves_past_other_events(self, sleep):
+        client = beanstalker.get_client()
+        start = datetime.now(timezone.utc)
+        starting = {"EventDate": start + timedelta(seconds=1), "EnvironmentName": "app1-dev", "Message": "starting"}
+        other = {"EventDate": start + timedelta(seconds=2), "EnvironmentName": "app1-qa", "Message": "other env"}
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Updating"},
+            {"ApplicationName": "app1", "EnvironmentName": "app1-stg", "EnvironmentId": "e-2", "Status": "Ready"}]})
+        stubber.add_response("describe_events", {"Events": [starting, other]},
+                             {"StartTime": start, "ApplicationName": "app1"})
+        stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Ready"}]})
+        stubber.add_response("describe_events", {"Events": [other]},
+                             {"StartTime": other["EventDate"], "ApplicationName": "app1"})
+        stubber.activate()
+        events = []
+        beanstalker.wait_for_environments(client, ["e-1", "e-2"], on_event=events.append, start_time=start)
+        stubber.assert_no_pending_responses()
+        self.assertEqual([event["Message"] for event in events], ["starting"])
+
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_wait_for_environments_timeout(self, sleep):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {"Environments": [
+            {"EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Updating"}]})
+        stubber.add_response("describe_events", {"Events": []})
+        stubber.activate()
+        envs = beanstalker.wait_for_environments(client, ["e-1"], timeout=0)
+        self.assertEqual(envs["e-1"]["Status"], "Updating")
+
+    def test_dedup_options_to_remove(self):
+        self.assertEqual(beanstalker.dedup_options_to_remove({"NAME": "1"}, [" NAME", "OTHER", "OTHER "]), ["OTHER"])
+
+    def test_update_env_removes_in_same_call(self):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_response("update_environment", {
+            "EnvironmentName": "app1-dev", "ResponseMetadata": {"HTTPStatusCode": 200}}, {
+            "ApplicationName": "app1", "EnvironmentId": "e-1",
+            "OptionSettings": [beanstalker.create_env_option("NAME", "1")],
+            "OptionsToRemove": [beanstalker.create_env_option_removal("OLD")]})
+        stubber.activate()
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertTrue(beanstalker.update_env(client, "app1", "e-1", {"NAME": "1"}, [" NAME", "OLD"]))
+        stubber.assert_no_pending_responses()
+        self.assertEqual(beanstalker.API_CALLS, {"UpdateEnvironment": 1})
+
+    def test_apply_plans_survives_connection_errors(self):
+        from botocore.exceptions import EndpointConnectionError
+
+        def update_environment(EnvironmentId, **kwargs):
+            if EnvironmentId == "e-1":
+                raise EndpointConnectionError(endpoint_url="https://elasticbeanstalk.us-east-1.amazonaws.com")
+            return {"EnvironmentName": EnvironmentId, "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+        client = mock.Mock()
+        client.update_environment.side_effect = update_environment
+        plans = [beanstalker.ChangeSet(beanstalker.EnvironmentRef("us-east-1", "app1", "e-{}".format(idx)),
+                                       {"A": "1"}, [], {}) for idx in range(3)]
+        with mock.patch('beanstalker.beanstalker.get_client', return_value=client):
+            results = beanstalker.apply_plans(plans, concurrency=1)
+        self.assertEqual({env_id: result.error is None for env_id, result in results.items()},
+                         {"e-0": True, "e-1": False, "e-2": True})
+        self.assertIn("Could not connect", results["e-1"].error)
+        self.assertEqual(client.update_environment.call_count, 3)
+
+    def test_load_yaml_is_safe(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "unsafe.yml")
+            beanstalker.to_file(filename, "EnvConfig: !!python/object/apply:os.getcwd []\n")
+            with self.assertRaises(beanstalker.yaml.YAMLError):
+                beanstalker.load_yaml(filename)
+
+    def test_config_file_store_reloads_changed_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = write_config_file(directory, {"A": "1"}, "e-1", "first.yml")
+            write_config_file(directory, {"B": "1"}, "e-2", "second.yml")
+            store = beanstalker.ConfigFileStore([directory])
+            self.assertEqual(len(store.refresh()), 2)
+            write_config_file(directory, {"A": "2"}, "e-1", "first.yml")
+            os.utime(first, ns=(0, 0))
+            with mock.patch('beanstalker.beanstalker.load_yaml', wraps=beanstalker.load_yaml) as load_yaml:
+                configs = {config['EnvironmentID']: config for config in store.refresh()}
+            load_yaml.assert_called_once_with(first)
+            self.assertEqual(configs['e-1']['EnvConfig'], {"A": "2"})
+
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_watch_reports_drift(self, sleep):
+        env = {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1",
+               "DateUpdated": datetime(2018, 1, 1)}
+        stubber = Stubber(beanstalker.get_client("us-east-1"))
+        stubber.add_response("describe_environments", {"Environments": [env]})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "1"}))
+        stubber.add_response("describe_environments", {"Environments": [dict(env, DateUpdated=datetime(2018, 1, 2))]})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"A": "console"}))
+        stubber.add_response("describe_environments", {"Environments": [dict(env, DateUpdated=datetime(2018, 1, 2))]})
+        stubber.activate()
+        reports = []
+        with tempfile.TemporaryDirectory() as directory:
+            write_config_file(directory, {"A": "1"})
+            beanstalker.watch([directory], interval=60, iterations=3, report=reports.append)
+        stubber.assert_no_pending_responses()
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0].modified, {"A": ("1", "console")})
+        self.assertEqual(beanstalker.API_CALLS, {"DescribeEnvironments": 3, "DescribeConfigurationSettings": 2})
+
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_watch_survives_connection_errors(self, sleep):
+        env = {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1",
+               "DateUpdated": datetime(2018, 1, 1)}
+        error = botocore.exceptions.EndpointConnectionError(endpoint_url="https://elasticbeanstalk.amazonaws.com")
+        reports = []
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch('beanstalker.beanstalker.describe_environment', side_effect=[error, env]), \
+                mock.patch('beanstalker.beanstalker.get_environment_variables', return_value={"A": "console"}), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            write_config_file(directory, {"A": "1"})
+            beanstalker.watch([directory], interval=60, iterations=2, report=reports.append)
+        self.assertIn("Failed to check environment e-1", stdout.getvalue())
+        self.assertEqual([report.modified for report in reports], [{"A": ("1", "console")}])
+
+    def test_iter_changes_ordered(self):
+        changes = list(beanstalker.iter_changes({"b": "1", "a": "new", "d": "4"}, {"a": "old", "b": "1", "c": "3"},
+                                                ordered=True))
+        self.assertEqual(changes, [
+            (beanstalker.MODIFIED, "a", "new", "old"),
+            (beanstalker.REMOVED, "c", None, "3"),
+            (beanstalker.ADDED, "d", "4", None),
+        ])
+
+    def test_diff_snapshots(self):
+        old = {"e-1": beanstalker.digest_config(self.testDict1), "e-2": beanstalker.digest_config({"A": "1"})}
+        changed = dict(self.testDict1, param1="changed")
+        new = {"e-1": beanstalker.digest_config(changed), "e-2": beanstalker.digest_config({"A": "1"}),
+               "e-3": beanstalker.digest_config({"B": "1"})}
+        diffs = dict(beanstalker.diff_snapshots(old, new))
+        self.assertEqual(sorted(diffs), ["e-1", "e-3"])
+        self.assertEqual([(change, key) for change, key, new, old in diffs["e-1"]], [(beanstalker.MODIFIED, "param1")])
+        self.assertEqual(diffs["e-3"][0][:2], (beanstalker.ADDED, "B"))
+
+    def test_export_and_query_snapshot(self):
+        configs = [
+            {"ApplicationName": "app1", "Region": "us-east-1", "EnvironmentID": "e-1", "EnvironmentName": "app1-dev",
+             "EnvConfig": {"HTTP_CACHE": "FALSE", "ENV": "dev"}},
+            {"ApplicationName": "app1", "Region": "eu-west-1", "EnvironmentID": "e-2", "EnvironmentName": "app1-prd",
+             "EnvConfig": {"HTTP_CACHE": "TRUE", "ENV": "prod"}},
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "snapshot.db")
+            fetched_at = [datetime(2018, 1, 1, tzinfo=timezone.utc), datetime(2018, 1, 1, 0, 5, tzinfo=timezone.utc)]
+            beanstalker.export_snapshot(filename, list(zip(configs, fetched_at)))
+            self.assertEqual(beanstalker.query_snapshot(filename, "HTTP_CACHE", "FALSE"),
+                             [("us-east-1", "app1", "app1-dev", "e-1", "FALSE")])
+            self.assertEqual([row[3] for row in beanstalker.query_snapshot(filename, "HTTP_CACHE")], ["e-2", "e-1"])
+            self.assertEqual(beanstalker.query_snapshot(filename, "MISSING"), [])
+            connection = sqlite3.connect(filename)
+            try:
+                rows = connection.execute("SELECT environment_id, fetched_at FROM environments ORDER BY 1").fetchall()
+            finally:
+                connection.close()
+            self.assertEqual(rows, [("e-1", "2018-01-01T00:00:00+00:00"), ("e-2", "2018-01-01T00:05:00+00:00")])
+            not_sqlite = os.path.join(directory, "config.yml")
+            write_config_file(directory, {"A": "1"})
+            for bad_snapshot in (os.path.join(directory, "missing.db"), not_sqlite):
+                with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                    exit_code = beanstalker.main(["query", bad_snapshot, "--variable", "A"])
+                self.assertEqual(exit_code, beanstalker.EXIT_ERROR)
+                self.assertIn("can't read snapshot", stdout.getvalue())
+
+    def test_profiler_spans(self):
+        stream = io.StringIO()
+        beanstalker.PROFILER.enable(stream)
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        self.stub_live_config(stubber, {"A": "1"})
+        stubber.activate()
+        beanstalker.get_config(client, "us-east-1", "app1", "e-1")
+        spans = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([span["span"] for span in spans],
+                         ["client", "api.DescribeEnvironments", "api.DescribeConfigurationSettings", "fetch"])
+        self.assertEqual(spans[1]["region"], "us-east-1")
+        summary = beanstalker.PROFILER.summary().splitlines()
+        self.assertEqual([line.split()[0] for line in summary[1:]],
+                         ["api.DescribeConfigurationSettings", "api.DescribeEnvironments", "client", "fetch"])
+
+    def test_profiler_yaml_spans_record_bytes(self):
+        stream = io.StringIO()
+        beanstalker.PROFILER.enable(stream)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "config.yml")
+            beanstalker.to_file(filename, beanstalker.dump_yaml({"EnvConfig": {"A": "1"}}))
+            beanstalker.load_yaml(filename)
+            size = os.path.getsize(filename)
+        spans = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(span["span"], span["bytes"]) for span in spans],
+                         [("dump", size), ("write", size), ("load", size)])
+
+    def test_profiler_disabled(self):
+        with beanstalker.PROFILER.span("stage") as span:
+            span["bytes"] = 10
+        self.assertEqual(beanstalker.PROFILER.spans, {})
+
+    def test_config_resolver_extends(self):
+        with tempfile.TemporaryDirectory() as directory:
+            beanstalker.save_yaml(os.path.join(directory, "base.yml"), {
+                "ApplicationName": "app1", "Region": "us-east-1", "EnvConfig": {"A": "base", "B": "base", "C": "base"}})
+            beanstalker.save_yaml(os.path.join(directory, "prod.yml"), {
+                "Extends": "base.yml", "EnvConfig": {"B": "prod"}})
+            beanstalker.save_yaml(os.path.join(directory, "dev.yml"), {
+                "Extends": ["prod.yml"], "EnvironmentID": "e-1", "EnvConfig": {"A": "dev", "C": None}})
+            beanstalker.save_yaml(os.path.join(directory, "stg.yml"), {
+                "Extends": "base.yml", "EnvironmentID": "e-2", "Region": "eu-west-1"})
+            resolver = beanstalker.ConfigResolver()
+            with mock.patch('beanstalker.beanstalker.load_yaml', wraps=beanstalker.load_yaml) as load_yaml:
+                configs = beanstalker.load_config_files([directory], resolver)
+            self.assertEqual(load_yaml.call_count, 4)
+        self.assertEqual([config['EnvironmentID'] for config in configs], ["e-1", "e-2"])
+        self.assertEqual(configs[0]['EnvConfig'], {"A": "dev", "B": "prod"})
+        self.assertEqual(configs[0]['ApplicationName'], "app1")
+        self.assertNotIn('Extends', configs[0])
+        self.assertEqual(configs[1]['Region'], "eu-west-1")
+        self.assertEqual(configs[1]['EnvConfig'], {"A": "base", "B": "base", "C": "base"})
+
+    def test_config_resolver_circular(self):
+        with tempfile.TemporaryDirectory() as directory:
+            beanstalker.save_yaml(os.path.join(directory, "a.yml"), {"Extends": "b.yml"})
+            beanstalker.save_yaml(os.path.join(directory, "b.yml"), {"Extends": "a.yml"})
+            with self.assertRaises(beanstalker.ConfigError):
+                beanstalker.ConfigResolver().resolve(os.path.join(directory, "a.yml"))
+
+    def test_config_resolver_bad_bases(self):
+        with tempfile.TemporaryDirectory() as directory:
+            beanstalker.save_yaml(os.path.join(directory, "missing.yml"), {"Extends": "nope.yml"})
+            beanstalker.save_yaml(os.path.join(directory, "list.yml"), ["not", "a", "mapping"])
+            beanstalker.save_yaml(os.path.join(directory, "not-mapping.yml"), {"Extends": "list.yml"})
+            with open(os.path.join(directory, "broken.yml"), "w") as f:
+                f.write("EnvConfig: [unclosed\n")
+            beanstalker.save_yaml(os.path.join(directory, "bad-yaml.yml"), {"Extends": "broken.yml"})
+            beanstalker.save_yaml(os.path.join(directory, "number.yml"), {"Extends": 5})
+            beanstalker.save_yaml(os.path.join(directory, "number-list.yml"), {"Extends": [1]})
+            beanstalker.save_yaml(os.path.join(directory, "bad-extends.yml"), {"Extends": "number.yml"})
+            beanstalker.save_yaml(os.path.join(directory, "bad-extends-list.yml"), {"Extends": "number-list.yml"})
+            for name, message in (("missing.yml", "can't read"), ("not-mapping.yml", "must be a mapping"),
+                                  ("bad-yaml.yml", "invalid yaml"),
+                                  ("bad-extends.yml", "must be a file name or a list of them"),
+                                  ("bad-extends-list.yml", "must be a file name or a list of them")):
+                with self.assertRaises(beanstalker.ConfigError) as raised:
+                    beanstalker.ConfigResolver().resolve(os.path.join(directory, name))
+                self.assertIn(message, str(raised.exception))
+                self.assertIn("extended by {}".format(os.path.join(directory, name)), str(raised.exception))
+
+    def test_config_errors_exit_cleanly(self):
+        with tempfile.TemporaryDirectory() as directory:
+            list_env_config = os.path.join(directory, "list.yml")
+            beanstalker.save_yaml(list_env_config, {"EnvironmentID": "e-1", "EnvConfig": ["A", "B"]})
+            no_region = os.path.join(directory, "no-region.yml")
+            beanstalker.save_yaml(no_region, {"ApplicationName": "app1", "EnvironmentID": "e-1", "EnvConfig": {}})
+            for filename, message in ((list_env_config, "EnvConfig of"), (no_region, "is missing Region")):
+                with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                    self.assertEqual(beanstalker.main(["plan", filename]), beanstalker.EXIT_ERROR)
+                self.assertIn(message, stdout.getvalue())
+
+    def test_secret_resolver_batches_and_caches(self):
+        LocalSecretProvider.batches = []
+        resolver = beanstalker.SecretResolver({"local": LocalSecretProvider})
+        file_configs = [
+            {"Region": "us-east-1", "EnvConfig": {"DB_PASSWORD": "{{resolve:local:db}}", "ENV": "dev",
+                                                  "API_KEY": "{{resolve:local:api}}"}}
+            for _ in range(200)
+        ]
+        file_configs.append({"Region": "eu-west-1", "EnvConfig": {"DB_PASSWORD": "{{resolve:local:db}}"}})
+        resolver.resolve_configs(file_configs)
+        self.assertEqual(LocalSecretProvider.batches, [("us-east-1", ["api", "db"]), ("eu-west-1", ["db"])])
+        self.assertEqual(file_configs[0]["EnvConfig"], {"DB_PASSWORD": "plain-db", "ENV": "dev", "API_KEY": "plain-api"})
+        self.assertEqual(file_configs[0]["SecretKeys"], ["DB_PASSWORD", "API_KEY"])
+        again = [{"Region": "us-east-1", "EnvConfig": {"DB_PASSWORD": "{{resolve:local:db}}"}}]
+        resolver.resolve_configs(again)
+        self.assertEqual(len(LocalSecretProvider.batches), 2)
+        self.assertEqual(again[0]["EnvConfig"]["DB_PASSWORD"], "plain-db")
+
+    def test_secret_resolver_keeps_resolved_secrets_masked(self):
+        resolver = beanstalker.SecretResolver({"local": LocalSecretProvider})
+        file_config = {"ApplicationName": "app1", "Region": "us-east-1", "EnvironmentID": "e-1",
+                       "EnvConfig": {"DB_PASSWORD": "{{resolve:local:db}}"}}
+        resolver.resolve_configs([file_config])
+        resolver.resolve_configs([file_config])
+        self.assertEqual(file_config["SecretKeys"], ["DB_PASSWORD"])
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            beanstalker.print_drift(beanstalker.plan_update(file_config, {"DB_PASSWORD": "old"}))
+        self.assertNotIn("plain-db", stdout.getvalue())
+
+    def test_secret_resolver_errors(self):
+        resolver = beanstalker.SecretResolver({"local": LocalSecretProvider})
+        with self.assertRaises(beanstalker.SecretError):
+            resolver.resolve_configs([{"Region": "us-east-1", "EnvConfig": {"A": "{{resolve:local:missing}}"}}])
+        with self.assertRaises(beanstalker.SecretError):
+            resolver.resolve_configs([{"Region": "us-east-1", "EnvConfig": {"A": "{{resolve:unknown:x}}"}}])
+        kms = mock.Mock()
+        with mock.patch('beanstalker.beanstalker.boto3.session.Session', return_value=kms):
+            with self.assertRaises(beanstalker.SecretError) as raised:
+                beanstalker.SecretResolver().resolve_configs([
+                    {"Region": "us-east-1", "EnvConfig": {"A": "{{resolve:kms:not base64!}}"}}])
+            self.assertIn("kms secret not base64!", str(raised.exception))
+            kms.client.return_value.get_parameters.side_effect = botocore.exceptions.ClientError(
+                {"Error": {"Code": "AccessDeniedException"}}, "GetParameters")
+            with self.assertRaises(beanstalker.SecretError) as raised:
+                beanstalker.SecretResolver().resolve_configs([
+                    {"Region": "us-east-1", "EnvConfig": {"A": "{{resolve:ssm:/db/password}}"}}])
+            self.assertIn("AccessDeniedException", str(raised.exception))
+
+    def test_plan_masks_secrets(self):
+        file_config = {"ApplicationName": "app1", "Region": "us-east-1", "EnvironmentID": "e-1",
+                       "EnvConfig": {"DB_PASSWORD": "new-secret", "ENV": "dev"}, "SecretKeys": ["DB_PASSWORD"]}
+        plan = beanstalker.plan_update(file_config, {"DB_PASSWORD": "old-secret"})
+        self.assertEqual(plan.modified["DB_PASSWORD"], ("new-secret", "old-secret"))
+        self.assertEqual(plan.to_dict()["Modified"]["DB_PASSWORD"]["New"], beanstalker.SECRET_MASK)
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            beanstalker.print_plan(plan)
+        self.assertNotIn("secret", stdout.getvalue())
+        self.assertIn("ENV: dev", stdout.getvalue())
+
+    def test_rolling_apply_stops_on_unhealthy_wave(self):
+        plans = [beanstalker.ChangeSet(beanstalker.EnvironmentRef("us-east-1", "app1", "e-{}".format(idx)),
+                                       {"A": "1"}, [], {}) for idx in range(5)]
+        applied = lambda wave, concurrency, cache: {plan.ref.env_id: plan for plan in wave}
+        healthy = lambda wave, timeout, require_green, start_time, on_event: {
+            plan.ref.env_id: plan.ref.env_id != "e-3" for plan in wave}
+        waves = []
+        with mock.patch('beanstalker.beanstalker.apply_plans', side_effect=applied) as apply_plans, \
+                mock.patch('beanstalker.beanstalker.wait_for_plans', side_effect=healthy):
+            results = beanstalker.rolling_apply(plans, wave_size=2, on_wave=lambda *wave: waves.append(wave[:2]))
+        self.assertEqual([len(call[0][0]) for call in apply_plans.call_args_list], [2, 2])
+        self.assertEqual(waves, [(1, 3), (2, 3)])
+        self.assertEqual({env_id: result and result.error is None for env_id, result in results.items()},
+                         {"e-0": True, "e-1": True, "e-2": True, "e-3": False, "e-4": None})
+        self.assertIn("Green", results["e-3"].error)
+        with self.assertRaises(ValueError):
+            beanstalker.rolling_apply(plans, wave_size=0)
+        for wave_size in ("0", "-1"):
+            with mock.patch('sys.stderr', new_callable=io.StringIO), self.assertRaises(SystemExit):
+                beanstalker.main(["update", "config.yml", "--wave-size", wave_size])
+
+    @mock.patch('beanstalker.beanstalker.time.sleep')
+    def test_wait_for_environments_settle_health(self, sleep):
+        client = beanstalker.get_client()
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {"Environments": [
+            {"EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Ready", "Health": "Grey"}]})
+        stubber.add_response("describe_events", {"Events": []})
+        stubber.add_response("describe_environments", {"Environments": [
+            {"EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Ready", "Health": "Green"}]})
+        stubber.add_response("describe_events", {"Events": []})
+        stubber.activate()
+        envs = beanstalker.wait_for_environments(client, ["e-1"], settle_health=True)
+        stubber.assert_no_pending_responses()
+        self.assertEqual(envs["e-1"]["Health"], "Green")
+
+    def test_offline_commands_skip_heavy_imports(self):
+        script = ("import sys; from beanstalker import beanstalker; beanstalker.main(sys.argv[1:]); "
+                  "print(' '.join(name for name in ('boto3', 'botocore', 'yaml', 'multiprocessing') "
+                  "if name in sys.modules))")
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = os.path.join(directory, "fleet.db")
+            beanstalker.export_snapshot(snapshot, [({
+                "EnvironmentID": "e-1", "Region": "us-east-1", "ApplicationName": "app1",
+                "EnvironmentName": "app1-dev", "EnvConfig": {"A": "1"}}, datetime(2018, 1, 1, tzinfo=timezone.utc))])
+            output = subprocess.run([sys.executable, "-c", script, "query", snapshot, "--variable", "A"],
+                                    stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        self.assertIn("e-1", output)
+        self.assertEqual(output.splitlines()[-1], "")
+
+    def test_validate_config_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            beanstalker.save_yaml(os.path.join(directory, "base.yml"), {
+                "ApplicationName": "app1", "Region": "us-east-1", "EnvConfig": {"A": "1"}})
+            beanstalker.save_yaml(os.path.join(directory, "dev.yml"), {
+                "Extends": "base.yml", "EnvironmentID": "e-1", "EnvConfig": {"B": "2"}})
+            beanstalker.save_yaml(os.path.join(directory, "bad.yml"), {
+                "ApplicationName": "app1", "EnvironmentId": "e-2", "EnvConfig": {
+                    " A": "1", "B": 2, "C": "x" * 257, "D": "{{resolve:vault:db}}"}})
+            beanstalker.save_yaml(os.path.join(directory, "big.yml"), {
+                "Extends": ["base.yml", "missing.yml"], "EnvironmentID": "e-1",
+                "EnvConfig": {"VAR_{}".format(idx): "x" * 200 for idx in range(20)}})
+            report = beanstalker.validate_config_files([directory])
+        report = {os.path.basename(filename): errors for filename, errors in report.items()}
+        self.assertEqual(report["base.yml"], [])
+        self.assertEqual(len(report["dev.yml"]), 1)
+        self.assertIn("big.yml also configures environment e-1", report["dev.yml"][0])
+        self.assertEqual(report["bad.yml"], [
+            "unknown key 'EnvironmentId'",
+            "variable ' A' has whitespace around its name",
+            "variable B is 2, quote it to make it a string",
+            "variable C is longer than 256 characters",
+            "variable D uses unknown secret scheme 'vault'",
+            "missing Region, EnvironmentID",
+        ])
+        self.assertEqual(report["big.yml"][0], "Extends missing.yml which doesn't exist")
+        self.assertIn("more than Beanstalk's limit of 4096", report["big.yml"][1])
+        self.assertEqual(len(report["big.yml"]), 2)
+
+    def test_validate_uses_content_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_config_file(directory, {"A": "1"})
+            write_config_file(directory, {"A": 1}, env_id="e-2", name="other.yml")
+            argv = ["validate", directory, "--cache-dir", os.path.join(directory, "cache")]
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                self.assertEqual(beanstalker.main(argv), beanstalker.EXIT_ERROR)
+            self.assertIn("Checked 2 files, 1 with errors", stdout.getvalue())
+            with mock.patch('beanstalker.beanstalker.check_config_content') as check, \
+                    mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                self.assertEqual(beanstalker.main(argv), beanstalker.EXIT_ERROR)
+            check.assert_not_called()
+            self.assertIn("variable A is 1, quote it", stdout.getvalue())
+
+    def test_main_set_skips_matching_environments(self):
+        stubber = Stubber(beanstalker.get_client("us-east-1"))
+        stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Ready"},
+            {"ApplicationName": "app1", "EnvironmentName": "app1-prd", "EnvironmentId": "e-2", "Status": "Ready"},
+            {"ApplicationName": "app1", "EnvironmentName": "app1-stg", "EnvironmentId": "e-3", "Status": "Ready"},
+            {"ApplicationName": "app1", "EnvironmentName": "app1-old", "EnvironmentId": "e-4",
+             "Status": "Terminated"}]}, {"ApplicationName": "app1", "IncludeDeleted": False})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"KEY": "new", "B": "1"}))
+        stubber.add_response("describe_configuration_settings", config_settings_response({"KEY": "old"}))
+        stubber.add_response("describe_configuration_settings", config_settings_response({"B": "1"}))
+        stubber.add_response("update_environment", {
+            "EnvironmentName": "app1-prd", "ResponseMetadata": {"HTTPStatusCode": 200}}, {
+            "ApplicationName": "app1", "EnvironmentId": "e-2",
+            "OptionSettings": [beanstalker.create_env_option("KEY", "new")]})
+        stubber.add_response("update_environment", {
+            "EnvironmentName": "app1-stg", "ResponseMetadata": {"HTTPStatusCode": 200}}, {
+            "ApplicationName": "app1", "EnvironmentId": "e-3",
+            "OptionSettings": [beanstalker.create_env_option("KEY", "new")]})
+        stubber.activate()
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            exit_code = beanstalker.main(["set", "KEY=new", "--app-name", "app1", "--region", "us-east-1",
+                                          "--concurrency", "1", "--yes"])
+        stubber.assert_no_pending_responses()
+        self.assertEqual(exit_code, beanstalker.EXIT_OK)
+        self.assertIn("Skipping 1 of 3 environments that already match", stdout.getvalue())
+
+    def test_main_set_reports_fetch_errors_per_environment(self):
+        stubber = Stubber(beanstalker.get_client("us-east-1"))
+        stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Ready"},
+            {"ApplicationName": "app1", "EnvironmentName": "app1-prd", "EnvironmentId": "e-2", "Status": "Ready"}]})
+        stubber.add_client_error("describe_configuration_settings", service_error_code="AccessDenied",
+                                 http_status_code=403)
+        stubber.add_response("describe_configuration_settings", config_settings_response({"KEY": "old"}))
+        stubber.add_response("update_environment", {
+            "EnvironmentName": "app1-prd", "ResponseMetadata": {"HTTPStatusCode": 200}}, {
+            "ApplicationName": "app1", "EnvironmentId": "e-2",
+            "OptionSettings": [beanstalker.create_env_option("KEY", "new")]})
+        stubber.activate()
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            exit_code = beanstalker.main(["set", "KEY=new", "--app-name", "app1", "--region", "us-east-1",
+                                          "--concurrency", "1", "--yes"])
+        stubber.assert_no_pending_responses()
+        self.assertEqual(exit_code, beanstalker.EXIT_ERROR)
+        self.assertIn("e-1: failed to fetch environment e-1", stdout.getvalue())
+        self.assertIn("AccessDenied", stdout.getvalue())
+
+    def test_unset_selects_by_pattern_and_tag(self):
+        client = beanstalker.get_client("us-east-1")
+        stubber = Stubber(client)
+        stubber.add_response("describe_environments", {"Environments": [
+            {"ApplicationName": "app1", "EnvironmentName": "app1-dev", "EnvironmentId": "e-1", "Status": "Ready",
+             "EnvironmentArn": "arn:env/app1/app1-dev"},
+            {"ApplicationName": "app1", "EnvironmentName": "app1-prd", "EnvironmentId": "e-2", "Status": "Ready",
+             "EnvironmentArn": "arn:env/app1/app1-prd"},
+            {"ApplicationName": "app2", "EnvironmentName": "app2-dev", "EnvironmentId": "e-3", "Status": "Ready",
+             "EnvironmentArn": "arn:env/app2/app2-dev"}]})
+        stubber.add_response("list_tags_for_resource", {"ResourceTags": [{"Key": "team", "Value": "web"}]},
+                             {"ResourceArn": "arn:env/app1/app1-dev"})
+        stubber.add_response("list_tags_for_resource", {"ResourceTags": [{"Key": "team", "Value": "api"}]},
+                             {"ResourceArn": "arn:env/app2/app2-dev"})
+        stubber.add_response("describe_configuration_settings", config_settings_response({"KEY": "1", "B": "2"}))
+        stubber.activate()
+        plans = beanstalker.plan_edits("us-east-1", beanstalker.parse_assignments(["KEY"], with_values=False),
+                                       concurrency=1, name_pattern="*-dev", tags={"team": "web"})
+        stubber.assert_no_pending_responses()
+        self.assertEqual([plan.ref.env_id for plan in plans], ["e-1"])
+        self.assertEqual(plans[0].removed, ["KEY"])
+        self.assertEqual((plans[0].added, plans[0].modified), ({}, {}))
+        with self.assertRaises(beanstalker.ConfigError):
+            beanstalker.parse_assignments(["KEY"])
 
+    def test_validate_reports_circular_extends(self):
+        with tempfile.TemporaryDirectory() as directory:
+            beanstalker.save_yaml(os.path.join(directory, "a.yml"), {"Extends": "b.yml", "EnvironmentID": "e-1"})
+            beanstalker.save_yaml(os.path.join(directory, "b.yml"), {"Extends": "a.yml"})
+            beanstalker.save_yaml(os.path.join(directory, "c.yml"), {"Extends": "c.yml", "EnvironmentID": "e-2"})
+            report = beanstalker.validate_config_files([directory])
+        report = {os.path.basename(filename): errors for filename, errors in report.items()}
+        self.assertIn("circular Extends", report["a.yml"][0])
+        self.assertIn("circular Extends", report["b.yml"][0])
+        self.assertIn("circular Extends", report["c.yml"][0])
 
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Throughput benchmark of the get, diff and update paths against a fake Beanstalk endpoint.
+
+Every scenario runs a fleet of FakeElasticBeanstalk environments with latency
+added to each request, so no AWS access is needed:
+
+    PYTHONPATH=. python benchmarks/bench_pipeline.py --envs 10,100,1000 --vars 10,500 --latency 0.02
+
+API calls go through beanstalker's RequestLayer with a TokenBucket of --max-rate
+requests per second, as they do against AWS, so rate limit waits are part of
+the wall time. Results can be saved with --save and later runs checked against them with
+--compare, which exits with status 1 when any stage got slower than --tolerance
+or made more API calls.
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+from beanstalker import beanstalker
+from fake_beanstalk import FakeElasticBeanstalk
+
+REGION = "us-east-1"
+
+
+def proposed_configs(fake: FakeElasticBeanstalk) -> list:
+    """Config files for every environment with a few variables added, modified and removed."""
+    file_configs = []
+    for env_id, env in fake.envs.items():
+        env_config = dict(fake.env_vars[env_id])
+        for idx, name in enumerate(sorted(env_config)[:3]):
+            if idx == 0:
+                del env_config[name]
+            else:
+                env_config[name] += "-changed"
+        env_config["BENCH_ADDED"] = "1"
+        file_configs.append({"ApplicationName": env['ApplicationName'], "Region": REGION, "EnvironmentID": env_id,
+                             "EnvironmentName": env['EnvironmentName'], "EnvConfig": env_config})
+    return file_configs
+
+
+def stages(fake: FakeElasticBeanstalk, client, concurrency: int) -> list:
+    file_configs = proposed_configs(fake)
+    live = {}
+    plans = []
+
+    def get_all():
+        for env, config, fetched_at, error in beanstalker.get_all_configs(client, REGION, concurrency):
+            live[env['EnvironmentId']] = config['EnvConfig']
+
+    def diff():
+        for file_config in file_configs:
+            beanstalker.dict_compare(file_config['EnvConfig'], live[file_config['EnvironmentID']])
+
+    def changes():
+        for file_config in file_configs:
+            for change in beanstalker.iter_changes(file_config['EnvConfig'], live[file_config['EnvironmentID']]):
+                pass
+
+    def plan():
+        plans.extend(beanstalker.plan_updates(file_configs, concurrency))
+
+    def apply():
+        beanstalker.apply_changes(plans, concurrency)
+
+    return [("get_all_configs", get_all), ("dict_compare", diff), ("iter_changes", changes),
+            ("plan_updates", plan), ("apply_plans", apply)]
+
+
+def run_scenario(num_envs: int, num_vars: int, latency: float, concurrency: int, memory: bool,
+                 max_rate: float = beanstalker.RATE_LIMIT) -> dict:
+    fake = FakeElasticBeanstalk(num_envs, num_vars, latency=latency, region=REGION)
+    client = beanstalker.RequestLayer(fake, beanstalker.TokenBucket(max_rate))
+    results = {}
+    with mock.patch.object(beanstalker, 'get_client', return_value=client), \
+            contextlib.redirect_stdout(io.StringIO()):
+        for name, stage in stages(fake, client, concurrency):
+            calls_before = sum(fake.calls.values())
+            beanstalker.METRICS.reset()
+            if memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            stage()
+            wall_time = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if memory else None
+            if memory:
+                tracemalloc.stop()
+            results[name] = {"wall_time": wall_time, "api_calls": sum(fake.calls.values()) - calls_before,
+                             "rate_wait": beanstalker.METRICS.wait_time, "peak_memory": peak}
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for scenario, stage_results in results.items():
+        for stage, result in stage_results.items():
+            base = baseline.get(scenario, {}).get(stage)
+            if not base:
+                continue
+            if result['wall_time'] > base['wall_time'] * (1 + tolerance):
+                regressions.append("{} {}: {:.3f}s, baseline {:.3f}s".format(
+                    scenario, stage, result['wall_time'], base['wall_time']))
+            if result['api_calls'] > base['api_calls']:
+                regressions.append("{} {}: {} API calls, baseline {}".format(
+                    scenario, stage, result['api_calls'], base['api_calls']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark get, diff and update paths against a fake Beanstalk")
+    parser.add_argument('--envs', default="10,100,1000", help="comma separated fleet sizes")
+    parser.add_argument('--vars', default="10,500", help="comma separated numbers of variables per environment")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds added to every API request")
+    parser.add_argument('--concurrency', type=int, default=beanstalker.DEFAULT_CONCURRENCY)
+    parser.add_argument('--max-rate', type=float, default=beanstalker.RATE_LIMIT,
+                        help="requests per second the token bucket allows, as with beanstalker --max-rate")
+    parser.add_argument('--memory', action='store_true', help="trace peak memory (slows down the run)")
+    parser.add_argument('--save', help="write results as json to this file")
+    parser.add_argument('--compare', help="json results of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against --compare")
+    args = parser.parse_args()
+
+    results = {}
+    print("{:<20} {:<16} {:>10} {:>10} {:>10} {:>12}".format(
+        "scenario", "stage", "wall (s)", "api calls", "wait (s)", "peak (KiB)"))
+    for num_envs in map(int, args.envs.split(',')):
+        for num_vars in map(int, args.vars.split(',')):
+            scenario = "{}envs-{}vars".format(num_envs, num_vars)
+            results[scenario] = run_scenario(num_envs, num_vars, args.latency, args.concurrency, args.memory,
+                                             args.max_rate)
+            for stage, result in results[scenario].items():
+                peak = "{:.0f}".format(result['peak_memory'] / 1024) if result['peak_memory'] is not None else "-"
+                print("{:<20} {:<16} {:>10.3f} {:>10} {:>10.3f} {:>12}".format(
+                    scenario, stage, result['wall_time'], result['api_calls'], result['rate_wait'], peak))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Time CLI startup for commands that never talk to AWS, failing when one gets too slow.
+
+    PYTHONPATH=. python benchmarks/bench_startup.py --runs 20 --max-ms 150
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from beanstalker import beanstalker
+
+HEAVY_MODULES = ('boto3', 'botocore')
+
+
+def run(command: list) -> float:
+    start = time.perf_counter()
+    subprocess.run(command, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark startup time of offline beanstalker commands")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-ms', type=float, help="exit with 1 when a command's median exceeds this")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = os.path.join(directory, "fleet.db")
+        beanstalker.export_snapshot(snapshot, [({
+            "EnvironmentID": "e-1", "Region": "us-east-1", "ApplicationName": "app1",
+            "EnvironmentName": "app1-dev", "EnvConfig": {"A": "1"}}, datetime(2018, 1, 1, tzinfo=timezone.utc))])
+        config_file = os.path.join(directory, "config.yml")
+        beanstalker.save_yaml(config_file, {
+            "ApplicationName": "app1", "Region": "us-east-1", "EnvironmentID": "e-1", "EnvConfig": {"A": "1"}})
+        cli = [sys.executable, '-m', 'beanstalker.beanstalker']
+        commands = [
+            ("python only", [sys.executable, '-c', 'pass'], False),
+            ("--help", cli + ['--help'], True),
+            ("query", cli + ['query', snapshot, '--variable', 'A'], True),
+            ("validate", cli + ['validate', config_file, '--no-cache'], True),
+        ]
+        print("{:<12} {:>12} {:>12}".format("command", "median (ms)", "min (ms)"))
+        slow = False
+        for name, command, guarded in commands:
+            times = [run(command) for _ in range(args.runs)]
+            median = statistics.median(times) * 1000
+            print("{:<12} {:>12.1f} {:>12.1f}".format(name, median, min(times) * 1000))
+            slow = slow or (guarded and args.max_ms is not None and median > args.max_ms)
+    if slow:
+        print("Startup is slower than {} ms, check that {} are still imported lazily".format(
+            args.max_ms, " and ".join(HEAVY_MODULES)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Compare parse and dump times of config files with the pure Python and LibYAML backends.
+
+    PYTHONPATH=. python benchmarks/bench_yaml.py --files 200 --vars 500
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import yaml
+
+from beanstalker import beanstalker
+
+
+def generate_config(idx: int, num_vars: int) -> dict:
+    return {
+        "ApplicationName": "bench-app",
+        "Region": "us-east-1",
+        "EnvironmentID": "e-{:08d}".format(idx),
+        "EnvironmentName": "bench-env-{}".format(idx),
+        "EnvConfig": {"VARIABLE_{:05d}".format(n): "value-{}-{}".format(idx, n) * 3 for n in range(num_vars)},
+    }
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def bench(loader, dumper, configs: list, directory: str) -> tuple:
+    filenames = [os.path.join(directory, "{}.yml".format(idx)) for idx in range(len(configs))]
+
+    def dump():
+        for filename, config in zip(filenames, configs):
+            with open(filename, 'w') as f:
+                yaml.dump(config, f, Dumper=dumper, default_flow_style=False)
+
+    def load():
+        for filename in filenames:
+            with open(filename, 'r') as f:
+                yaml.load(f, Loader=loader)
+
+    return timed(dump), timed(load)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark yml parsing and dumping of generated config files")
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--vars', type=int, default=500)
+    args = parser.parse_args()
+
+    configs = [generate_config(idx, args.vars) for idx in range(args.files)]
+    backends = [("pure python", yaml.SafeLoader, yaml.SafeDumper)]
+    if yaml.__with_libyaml__:
+        backends.append(("libyaml", yaml.CSafeLoader, yaml.CSafeDumper))
+    else:
+        print("PyYAML was built without LibYAML, only the pure Python backend is available")
+    print("{} files with {} variables each, beanstalker uses {}".format(
+        args.files, args.vars, beanstalker.yaml_backend()[0].__name__))
+    print("{:<12} {:>10} {:>10}".format("backend", "dump (s)", "load (s)"))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, loader, dumper in backends:
+            dump_time, load_time = bench(loader, dumper, configs, directory)
+            print("{:<12} {:>10.3f} {:>10.3f}".format(name, dump_time, load_time))
+
+
+if __name__ == "__main__":
+    main()
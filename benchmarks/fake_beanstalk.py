@@ -0,0 +1,99 @@
+"""In-process stand-in for the Elastic Beanstalk API used by the benchmarks.
+
+Implements the handful of client methods beanstalker calls, with a fixed latency
+added to every request and a count of requests per operation.
+"""
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+ENV_NAMESPACE = 'aws:elasticbeanstalk:application:environment'
+
+
+class FakeElasticBeanstalk:
+
+    def __init__(self, num_envs: int, num_vars: int, envs_per_app: int = 10, latency: float = 0.02,
+                 page_size: int = 1000, region: str = "us-east-1"):
+        # What RequestLayer reads from a botocore client to rate limit and retry its calls
+        self.meta = SimpleNamespace(region_name=region, method_to_api_mapping={
+            "describe_applications": "DescribeApplications",
+            "describe_environments": "DescribeEnvironments",
+            "describe_configuration_settings": "DescribeConfigurationSettings",
+            "update_environment": "UpdateEnvironment",
+            "describe_events": "DescribeEvents",
+        })
+        self.latency = latency
+        self.page_size = page_size
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        now = datetime.now(timezone.utc)
+        self.envs = {}
+        self.env_vars = {}
+        for idx in range(num_envs):
+            env_id = "e-{:08d}".format(idx)
+            self.envs[env_id] = {
+                "ApplicationName": "app-{}".format(idx // envs_per_app),
+                "EnvironmentName": "env-{:06d}".format(idx),
+                "EnvironmentId": env_id,
+                "Status": "Ready",
+                "Health": "Green",
+                "DateUpdated": now,
+            }
+            self.env_vars[env_id] = {"VARIABLE_{:05d}".format(n): "value-{}-{}".format(idx, n) for n in range(num_vars)}
+        self._by_name = {(env['ApplicationName'], env['EnvironmentName']): env_id for env_id, env in self.envs.items()}
+
+    def _call(self, operation: str):
+        with self._lock:
+            self.calls[operation] += 1
+        time.sleep(self.latency)
+
+    def _page(self, items: list, next_token: str = None, page_size: int = None) -> tuple:
+        page_size = page_size or self.page_size
+        start = int(next_token or 0)
+        end = start + page_size
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    def describe_applications(self, **kwargs):
+        self._call("DescribeApplications")
+        names = sorted({env['ApplicationName'] for env in self.envs.values()})
+        return {"Applications": [{"ApplicationName": name} for name in names]}
+
+    def describe_environments(self, ApplicationName=None, EnvironmentIds=None, NextToken=None, MaxRecords=None,
+                              **kwargs):
+        self._call("DescribeEnvironments")
+        envs = [self.envs[env_id] for env_id in EnvironmentIds if env_id in self.envs] if EnvironmentIds \
+            else list(self.envs.values())
+        if ApplicationName:
+            envs = [env for env in envs if env['ApplicationName'] == ApplicationName]
+        page, next_token = self._page(envs, NextToken, MaxRecords)
+        response = {"Environments": [dict(env) for env in page]}
+        if next_token:
+            response["NextToken"] = next_token
+        return response
+
+    def describe_configuration_settings(self, ApplicationName, EnvironmentName, **kwargs):
+        self._call("DescribeConfigurationSettings")
+        env_vars = self.env_vars[self._by_name[(ApplicationName, EnvironmentName)]]
+        options = [{"Namespace": ENV_NAMESPACE, "OptionName": name, "Value": value}
+                   for name, value in env_vars.items()]
+        options.append({"Namespace": "aws:autoscaling:asg", "OptionName": "MinSize", "Value": "1"})
+        return {"ConfigurationSettings": [{"ApplicationName": ApplicationName, "EnvironmentName": EnvironmentName,
+                                           "OptionSettings": options}]}
+
+    def update_environment(self, ApplicationName, EnvironmentId, OptionSettings=(), OptionsToRemove=(), **kwargs):
+        self._call("UpdateEnvironment")
+        env_vars = self.env_vars[EnvironmentId]
+        with self._lock:
+            for option in OptionsToRemove:
+                env_vars.pop(option['OptionName'], None)
+            for option in OptionSettings:
+                env_vars[option['OptionName']] = option['Value']
+            self.envs[EnvironmentId]['DateUpdated'] = datetime.now(timezone.utc)
+        return {"EnvironmentName": self.envs[EnvironmentId]['EnvironmentName'],
+                "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def describe_events(self, **kwargs):
+        self._call("DescribeEvents")
+        return {"Events": []}